@@ -1,12 +1,16 @@
 import tkinter as tk
 import threading
 import os
-from tkinter import filedialog, messagebox
+import time
+from tkinter import filedialog, messagebox, ttk
 from naveen import huffman
 from prashant import lzw
 from bhanu import RLE
 from nitin import dct_image
 from nitin import dct_video
+from instrumentation import Profile, format_profile
+from result_cache import open_cache, format_cache_stats
+import codec_selection
 
 # Main app window
 root = tk.Tk()
@@ -14,8 +18,14 @@ root.title("Text and Image Compressor")
 root.geometry("800x600")
 
 file_path = ""
+# Technique the "auto" choice maps each selected codec to
+AUTO_TECHNIQUES = {"huffman": "huffman-txt", "lzw": "lzw-txt", "RLE-text": "RLE-txt",
+                   "dct_image": "DCT-image", "dct_video": "DCT-video"}
 outputfilesize = [0]
 outputfile = ""
+# Results of earlier compressions, reused when the same content comes again
+# if "Reuse cached results" is ticked
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "file-compression")
 
 def upload_file():
     global file_path
@@ -31,10 +41,32 @@ def upload_file():
 def show_loading():
     loading_label.config(text="Processing... Please wait.")
     loading_label.pack(pady=5)
+    progress_bar["value"] = 0
+    progress_bar.pack(pady=5)
 
 def hide_loading():
     loading_label.config(text="")
     loading_label.pack_forget()
+    progress_bar.pack_forget()
+
+def show_progress(stage, fraction):
+    progress_bar["value"] = 100 * fraction
+    loading_label.config(text=f"Processing ({stage or 'starting'})... {100 * fraction:.0f}%")
+
+def make_profile():
+    # Codecs report from the processing thread, often many times a second;
+    # pass at most one update per stage every 50 ms to the Tk thread
+    last = {"time": 0.0, "stage": None}
+
+    def on_progress(stage, fraction):
+        now = time.monotonic()
+        if stage == last["stage"] and now - last["time"] < 0.05:
+            return
+        last["time"] = now
+        last["stage"] = stage
+        root.after(0, show_progress, stage, fraction)
+
+    return Profile(on_progress)
 
 def reset_application():
     global file_path, outputfile
@@ -55,7 +87,7 @@ def apply_technique():
     if file_path:
         if apply_button["text"] == "Compress File":
             output_label.config(text=f"Applying {selected_technique} on {file_path} for compression")
-            processing_thread = threading.Thread(target=process_file, args=(selected_technique, "compress"))
+            processing_thread = threading.Thread(target=process_file, args=(selected_technique, "compress", cache_var.get()))
             processing_thread.start()
         elif apply_button["text"] == "Decompress File":
             output_label.config(text=f"Applying {selected_technique} on {outputfile} for decompression")
@@ -64,26 +96,41 @@ def apply_technique():
     else:
         messagebox.showwarning("Warning", "Please upload a file to proceed.")
 
-def process_file(selected_technique, mode):
+def process_file(selected_technique, mode, use_cache=False):
     root.after(0, show_loading)
+    profile = make_profile()
+    cache = open_cache(CACHE_DIR) if use_cache else None
+    cache_before = cache.stats() if cache else None
     out =""
+    selection = None
     global outputfile
+    if mode == "compress" and selected_technique == "auto":
+        # Pick the technique from a sample of the file and show it, so that
+        # decompression uses the same one. The text techniques cannot read
+        # images or video, so those may go to the lossy DCT ones.
+        selection = codec_selection.select_codec(file_path, ("huffman", "lzw", "RLE-text"),
+                                                 lossy=True)
+        selected_technique = AUTO_TECHNIQUES[selection.codec]
+        root.after(0, compression_var.set, selected_technique)
     if mode == "compress":
         if selected_technique == "huffman-txt":
             outputfile = "comp-huffman-txt-output.txt"
-            huffman.huffman_encode(file_path, outputfile)
+            # Files the sample shows are not UTF-8 text are coded as bytes
+            binary = bool(selection and selection.stats and not selection.stats.phrase_length)
+            huffman.huffman_encode(file_path, outputfile, binary=binary, profile=profile,
+                                   cache=cache)
         elif selected_technique == "lzw-txt":
             outputfile = "comp-lzw-txt-output.txt"
-            lzw.lzw_compress(file_path, outputfile)
+            lzw.lzw_compress(file_path, outputfile, profile=profile, cache=cache)
         elif selected_technique == "RLE-txt":
             outputfile = "comp-rle-txt-output.txt"
-            RLE.compress_file(file_path, outputfile)
+            RLE.compress_file(file_path, outputfile, profile=profile)
         elif selected_technique == "DCT-video":
             outputfile = "comp-DCT-video-output.mp4"
-            dct_video.compress_video(file_path, outputfile)
+            dct_video.compress_video(file_path, outputfile, profile=profile)
         elif selected_technique == "DCT-image":
             outputfile = "comp-DCT-image-output.jpg"
-            dct_image.dct_image_compreser(file_path, outputfile)
+            dct_image.dct_image_compreser(file_path, outputfile, profile=profile, cache=cache)
             outputfilesize[0] = os.path.getsize(outputfile)
             # Disable decompression if DCT is used
             root.after(0, lambda: apply_button.config(text="Compress File", state="disabled"))
@@ -97,22 +144,34 @@ def process_file(selected_technique, mode):
     elif mode == "decompress":
         if selected_technique == "huffman-txt":
             out = "decomp-huffman-txt-output.txt"
-            huffman.huffman_decode(outputfile, "decomp-huffman-txt-output.txt")
+            huffman.huffman_decode(outputfile, "decomp-huffman-txt-output.txt", profile=profile)
         elif selected_technique == "lzw-txt":
             out = "decomp-lzw-txt-output.txt"
-            lzw.lzw_decompress(outputfile, "decomp-lzw-txt-output.txt")
+            lzw.lzw_decompress(outputfile, "decomp-lzw-txt-output.txt", profile=profile)
         elif selected_technique == "RLE-txt":
             out = "decomp-rle-txt-output.txt"
-            RLE.decompress_file(outputfile, "decomp-rle-txt-output.txt")
+            RLE.decompress_file(outputfile, "decomp-rle-txt-output.txt", profile=profile)
         
         # Reset application after decompression
         root.after(0, reset_application)
         outputfilesize[0] = os.path.getsize(out)
         
+    profile.finish()
     if outputfilesize[0]:
         size_mb = round(outputfilesize[0] / (1024 * 1024), 2)  # Convert to Megabytes for readability
+        stages = format_profile(profile)
+        if selection and selection.stats:
+            # Predicted against actual, so the choice can be checked
+            actual = os.path.getsize(file_path) / outputfilesize[0]
+            choice = f"auto: {codec_selection.describe(selection)}; actual ratio {actual:.2f}"
+            print(choice)
+            stages = f"{choice}\n{stages}"
+        if cache:
+            cache_used = {name: count - cache_before[name] for name, count in cache.stats().items()}
+            if cache_used["hits"] or cache_used["misses"]:
+                stages = f"{format_cache_stats(cache_used)}\n{stages}"
         root.after(0, lambda: output_label.config(
-            text=f"Output: {selected_technique} {mode}ion applied on file. Output file size: {size_mb} MB"))
+            text=f"Output: {selected_technique} {mode}ion applied on file. Output file size: {size_mb} MB\n{stages}"))
     else:
         root.after(0, lambda: output_label.config(
             text=f"Output: {selected_technique} {mode}ion applied on file, but no output file found."))
@@ -127,22 +186,28 @@ file_label.pack()
 
 # Dropdown for selecting compression technique
 compression_var = tk.StringVar(value="None")
-compression_techniques = ["None", "huffman-txt", "lzw-txt", "RLE-txt", "DCT-image","DCT-video"]
+compression_techniques = ["None", "auto", "huffman-txt", "lzw-txt", "RLE-txt", "DCT-image","DCT-video"]
 compression_menu = tk.OptionMenu(root, compression_var, *compression_techniques)
 compression_menu.config(width=25)
 compression_menu.pack(pady=10)
 compression_label = tk.Label(root, text="Select a compression technique:")
 compression_label.pack()
 
+# Off by default: with a cache, LZW writes the chunked format
+cache_var = tk.BooleanVar(value=False)
+cache_check = tk.Checkbutton(root, text=f"Reuse cached results ({CACHE_DIR})", variable=cache_var)
+cache_check.pack()
+
 # Apply button (initially set to compression mode)
 apply_button = tk.Button(root, text="Compress File", command=apply_technique, state="disabled")
 apply_button.pack(pady=10)
 
-# Loading label (hidden by default)
+# Loading label and progress bar (hidden by default)
 loading_label = tk.Label(root, text="", fg="blue")
+progress_bar = ttk.Progressbar(root, length=400, maximum=100)
 
 # Label to display output
-output_label = tk.Label(root, text="")
+output_label = tk.Label(root, text="", font=("Courier", 10), justify="left")
 output_label.pack(pady=20)
 
 root.mainloop()
@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Reproducible benchmark of every registered codec: generates synthetic
+# corpora, times compression and decompression of each applicable one in a
+# fresh process (so peak RSS is per operation), checks the round trip and
+# writes the results as JSON for comparing commits. MB/s and the printed
+# ratio are measured on decoded pixels for images and video. Usage:
+#   python benchmark.py -o before.json
+#   python benchmark.py -o after.json --baseline before.json
+
+# Which corpus kinds each codec is run on
+CODEC_KINDS = {
+    'huffman': ('binary', 'text'),
+    'lzw': ('text',),
+    'RLE': ('binary', 'text'),
+    'dct_image': ('image',),
+    'dct_video': ('video',),
+}
+
+# Common English words, most frequent first, for natural-language-like text
+WORDS = ("the of and to a in is it you that he was for on are with as I his they be at one "
+         "have this from or had by hot word but what some we can out other were all there "
+         "when up use your how said an each she which do their time if will way about many "
+         "then them write would like so these her long make thing see him two has look more "
+         "day could go come did number sound no most people my over know water than call "
+         "first who may down side been now find any new work part take get place made live "
+         "where after back little only round man year came show every good me give our under "
+         "name very through just form sentence great think say help low line differ turn "
+         "cause much mean before move right boy old too same tell does set three want air "
+         "well also play small end put home read hand port large spell add even land here "
+         "must big high such follow act why ask men change went light kind off need house "
+         "picture try us again animal point mother world near build self earth father").split()
+
+def random_bytes(rng, size):
+    return rng.integers(0, 256, size, dtype=np.uint8).tobytes()
+
+def byte_runs(rng, size):
+    """Runs of repeated bytes with geometric lengths (mean 32)."""
+    lengths = rng.geometric(1 / 32, size // 16 + 1)
+    values = rng.integers(0, 256, len(lengths), dtype=np.uint8)
+    return np.repeat(values, lengths)[:size].tobytes()
+
+def repeated_text(rng, size):
+    """One sentence over and over, like InputFiles/input.txt."""
+    line = "The quick brown fox jumps over the lazy dog.\n "
+    return (line * (size // len(line) + 1))[:size].encode('utf-8')
+
+def zipf_text(rng, size):
+    """Words drawn with Zipf frequencies, in sentences and lines."""
+    ranks = np.arange(1, len(WORDS) + 1)
+    weights = 1 / ranks
+    words = rng.choice(len(WORDS), size // 4, p=weights / weights.sum())
+    parts = []
+    length = 0
+    sentence = 0
+    for index in words:
+        word = WORDS[index]
+        if sentence == 0:
+            word = word.capitalize()
+        sentence += 1
+        if sentence > 6 and rng.random() < 0.15:
+            word += '.\n' if rng.random() < 0.3 else '.'
+            sentence = 0
+        parts.append(word)
+        length += len(word) + 1
+        if length >= size:
+            break
+    return ' '.join(parts)[:size].encode('utf-8')
+
+def synthetic_image(rng, height, width):
+    """Smooth color gradients with shapes and mild noise."""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float64)
+    image = np.stack([
+        128 + 100 * np.sin(x / (width / 7)) * np.cos(y / (height / 5)),
+        128 + 90 * np.cos((x + y) / (width / 4)),
+        255 * y / max(1, height - 1),
+    ], axis=-1)
+    for _ in range(12):
+        top, left = rng.integers(0, height), rng.integers(0, width)
+        image[top:top + height // 8, left:left + width // 8] = rng.integers(0, 256, 3)
+    image += rng.normal(0, 4, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def write_image(path, rng, height, width):
+    from PIL import Image
+    Image.fromarray(synthetic_image(rng, height, width)).save(path)
+
+def write_video(path, rng, height, width, frames):
+    """A static background with a moving block, as mp4v."""
+    import cv2
+    background = synthetic_image(rng, height, width)
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25, (width, height))
+    side = max(8, height // 6)
+    for t in range(frames):
+        frame = background.copy()
+        left = (t * 4) % max(1, width - side)
+        frame[height // 3:height // 3 + side, left:left + side] = 255
+        out.write(frame)
+    out.release()
+
+# Every corpus kind make_corpora can write
+KINDS = ('binary', 'text', 'image', 'video')
+
+def make_corpora(directory, scale=1.0, seed=0, kinds=KINDS):
+    """Write the synthetic corpora of the given kinds to directory; returns
+    (name, kind, path) triples.
+
+    Each corpus draws from its own generator seeded with seed and its
+    name, so it is the same whichever other kinds are written.
+    """
+    size = max(1024, int(scale * (1 << 20)))
+    corpora = []
+    byte_corpora = [
+        ('random', 'binary', random_bytes, size),
+        ('runs', 'binary', byte_runs, size),
+        ('repeated_text', 'text', repeated_text, 2 * size),
+        ('zipf_text', 'text', zipf_text, size),
+    ]
+    for name, kind, generate, length in byte_corpora:
+        if kind not in kinds:
+            continue
+        path = os.path.join(directory, name + ('.txt' if kind == 'text' else '.bin'))
+        with open(path, 'wb') as f:
+            f.write(generate(corpus_rng(seed, name), length))
+        corpora.append((name, kind, path))
+    if 'image' in kinds:
+        for height, width in ((256, 256), (1024, 1024), (1536, 2048)):
+            height, width = max(8, int(height * scale ** 0.5)), max(8, int(width * scale ** 0.5))
+            name = f'image_{width}x{height}'
+            path = os.path.join(directory, name + '.png')
+            write_image(path, corpus_rng(seed, name), height, width)
+            corpora.append((name, 'image', path))
+    if 'video' in kinds:
+        for height, width in ((240, 320), (360, 640)):
+            frames = max(2, int(60 * scale))
+            name = f'video_{width}x{height}'
+            path = os.path.join(directory, name + '.mp4')
+            write_video(path, corpus_rng(seed, name), height, width, frames)
+            corpora.append((name, 'video', path))
+    return corpora
+
+def corpus_rng(seed, name):
+    """Return the random generator of one corpus."""
+    return np.random.default_rng([seed, *name.encode()])
+
+
+def proc_status_mb(field):
+    """Read a memory field (such as VmRSS or VmHWM) of this process in MB, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its children, in MB.
+
+    On Linux the peak of this process is VmHWM, which unlike ru_maxrss is
+    not carried over from the parent that started it and can be reset.
+    """
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / (1 << 20)
+    own = proc_status_mb('VmHWM')
+    if own is None:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / (1 << 20)
+    return max(own, children)
+
+def reset_peak_rss():
+    """Restart the VmHWM peak from the current RSS where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _measure(codec_name, mode, input_path, output_path):
+    """Run one codec operation; returns (seconds, baseline RSS MB, peak RSS MB)."""
+    import codec_registry
+    codec = codec_registry.get_codec(codec_name)
+    reset_peak_rss()
+    baseline = proc_status_mb('VmRSS') or peak_rss_mb()
+    start = time.perf_counter()
+    getattr(codec, mode)(input_path, output_path)
+    return time.perf_counter() - start, baseline, peak_rss_mb()
+
+def measure(codec_name, mode, input_path, output_path):
+    """Run _measure in a fresh process so its peak RSS is its own."""
+    context = mp.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(_measure, codec_name, mode, input_path, output_path).result()
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else float(10 * np.log10(255 ** 2 / mse))
+
+def video_frames(path):
+    import cv2
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame)
+    cap.release()
+    return np.array(frames)
+
+def raw_size(kind, path):
+    """Bytes of decoded pixels for images and (grayscale) video, else None."""
+    if kind == 'image':
+        from PIL import Image
+        with Image.open(path) as image:
+            return image.width * image.height * len(image.getbands())
+    if kind == 'video':
+        import cv2
+        cap = cv2.VideoCapture(path)
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) * int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                * int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
+        return size
+    return None
+
+def check_round_trip(kind, original, restored):
+    """Return (round trip ok, PSNR for lossy kinds or None)."""
+    if kind in ('binary', 'text'):
+        with open(original, 'rb') as a, open(restored, 'rb') as b:
+            return a.read() == b.read(), None
+    if kind == 'image':
+        from PIL import Image
+        a = np.array(Image.open(original).convert('RGB'))
+        b = np.array(Image.open(restored).convert('RGB'))
+        return a.shape == b.shape, psnr(a, b) if a.shape == b.shape else None
+    a, b = video_frames(original), video_frames(restored)
+    return a.shape == b.shape, psnr(a, b) if a.shape == b.shape else None
+
+def run_benchmark(corpora, codecs, directory, repeat=1):
+    """Benchmark each codec on each applicable corpus; returns result dicts."""
+    import codec_registry
+    results = []
+    for codec_name in codecs:
+        codec = codec_registry.get_codec(codec_name)
+        for name, kind, path in corpora:
+            if kind not in CODEC_KINDS.get(codec_name, ()):
+                continue
+            compressed = os.path.join(directory, f'{name}.{codec_name}{codec.extension}')
+            restored = os.path.join(directory, f'{name}.{codec_name}.restored'
+                                    + (codec.restored_extension or os.path.splitext(path)[1]))
+            compress = min((measure(codec_name, 'compress', path, compressed) for _ in range(repeat)),
+                           key=lambda m: m[0])
+            decompress = min((measure(codec_name, 'decompress', compressed, restored)
+                              for _ in range(repeat)), key=lambda m: m[0])
+            input_bytes = os.path.getsize(path)
+            compressed_bytes = os.path.getsize(compressed)
+            ok, quality = check_round_trip(kind, path, restored)
+            # Media throughput and ratio are against the decoded pixels,
+            # since the inputs are themselves compressed files
+            raw_bytes = raw_size(kind, path)
+            mb = (raw_bytes or input_bytes) / (1 << 20)
+            results.append({
+                'codec': codec_name,
+                'corpus': name,
+                'kind': kind,
+                'input_bytes': input_bytes,
+                'raw_bytes': raw_bytes,
+                'compressed_bytes': compressed_bytes,
+                'ratio': input_bytes / compressed_bytes if compressed_bytes else None,
+                'raw_ratio': raw_bytes / compressed_bytes if raw_bytes and compressed_bytes else None,
+                'compress_s': compress[0],
+                'decompress_s': decompress[0],
+                'compress_mb_s': mb / compress[0] if compress[0] else None,
+                'decompress_mb_s': mb / decompress[0] if decompress[0] else None,
+                'baseline_rss_mb': compress[1],
+                'compress_peak_rss_mb': compress[2],
+                'decompress_peak_rss_mb': decompress[2],
+                'round_trip_ok': ok,
+                'psnr_db': quality,
+            })
+            print(format_result(results[-1]), flush=True)
+    return results
+
+def format_result(result):
+    psnr_text = f" psnr {result['psnr_db']:.1f}dB" if result['psnr_db'] is not None else ""
+    ratio = result['raw_ratio'] or result['ratio']
+    return (f"{result['codec']:>10} {result['corpus']:<18} ratio {ratio:8.3f}  "
+            f"comp {result['compress_mb_s']:8.2f} MB/s  decomp {result['decompress_mb_s']:8.2f} MB/s  "
+            f"rss {result['compress_peak_rss_mb']:7.1f}/{result['decompress_peak_rss_mb']:7.1f} MB  "
+            f"{'ok' if result['round_trip_ok'] else 'MISMATCH'}{psnr_text}")
+
+def compare(results, baseline):
+    """Print the change of each result against a previous JSON report."""
+    previous = {(r['codec'], r['corpus']): r for r in baseline['results']}
+    print(f"\nChange against {baseline['meta'].get('commit') or 'baseline'}:")
+    for result in results:
+        old = previous.get((result['codec'], result['corpus']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('compress_mb_s', 'decompress_mb_s', 'ratio', 'compress_peak_rss_mb',
+                    'decompress_peak_rss_mb'):
+            if old.get(key) and result.get(key):
+                changes.append(f"{key} {100 * (result[key] / old[key] - 1):+6.1f}%")
+        print(f"{result['codec']:>10} {result['corpus']:<18} " + "  ".join(changes))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every codec on synthetic corpora.")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON report path")
+    parser.add_argument('--codecs', nargs='+', default=list(CODEC_KINDS), choices=list(CODEC_KINDS))
+    parser.add_argument('--kinds', nargs='+', default=list(KINDS), choices=KINDS,
+                        help="corpus kinds to generate and run")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="corpus size factor (1.0: 1-2 MB byte corpora, images up to 2048x1536)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per operation; the fastest counts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus-dir', help="keep corpora and outputs here instead of a temp dir")
+    parser.add_argument('--baseline', help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.corpus_dir or temporary
+        os.makedirs(directory, exist_ok=True)
+        corpora = make_corpora(directory, args.scale, args.seed, args.kinds)
+        results = run_benchmark(corpora, args.codecs, directory, args.repeat)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    return 0 if all(r['round_trip_ok'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,21 @@
 import os
 
+import numpy as np
+
+from instrumentation import as_profile
+
+# Binary format: magic, original length (8 bytes), then frames. Each frame
+# holds a run count and the byte size of its length section (8 bytes each),
+# one value byte per run, then the run lengths as LEB128 varints.
+RLE_MAGIC = b'RLEB'
+
+# Bytes read per step by the streaming compressor
+STREAM_CHUNK = 1 << 24
+
+# Runs at least this long are written to the output with a slice fill
+# instead of being expanded through a temporary array
+LONG_RUN = 1 << 12
+
 def rle_compress(data: str) -> str:
     """Compress the given string using the RLE algorithm."""
     compressed = []
@@ -47,30 +63,231 @@ def rle_decompress(data: str) -> str:
     return ''.join(decompressed)
 
 
-def compress_file(input_file: str, output_file: str):
-    """Compress the contents of the input file and save to the output file."""
-    with open(input_file, 'r') as f:
+def encode_varints(numbers: np.ndarray) -> bytes:
+    """Encode unsigned integers as LEB128 varints, all at once."""
+    numbers = np.asarray(numbers, dtype=np.uint64)
+    if len(numbers) == 0:
+        return b''
+    sizes = np.ones(len(numbers), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += numbers >= np.uint64(1 << shift)
+    starts = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for k in range(int(sizes.max())):
+        mask = sizes > k
+        group = (numbers[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = np.where(sizes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[mask] + k] = group | more
+    return out.tobytes()
+
+
+def decode_varints(data: bytes) -> np.ndarray:
+    """Decode a buffer of LEB128 varints into a uint64 array."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(raw < 0x80)
+    if len(ends) == 0 or ends[-1] != len(raw) - 1:
+        raise ValueError("Truncated varint data")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(raw)) - np.repeat(starts, ends - starts + 1)
+    groups = (raw & 0x7F).astype(np.uint64) << (7 * positions).astype(np.uint64)
+    return np.add.reduceat(groups, starts)
+
+
+def find_runs(data: np.ndarray):
+    """Return the value and length of every run in a uint8 array."""
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(data)) + 1))
+    lengths = np.diff(np.append(starts, len(data))).astype(np.uint64)
+    return data[starts], lengths
+
+
+def encode_frame(values: np.ndarray, lengths: np.ndarray) -> bytes:
+    """Serialize one frame of runs."""
+    encoded_lengths = encode_varints(lengths)
+    return (len(values).to_bytes(8, 'big') + len(encoded_lengths).to_bytes(8, 'big')
+            + values.tobytes() + encoded_lengths)
+
+
+def rle_compress_bytes(data: bytes) -> bytes:
+    """Compress bytes into the binary RLE format."""
+    values, lengths = find_runs(np.frombuffer(data, dtype=np.uint8))
+    return RLE_MAGIC + len(data).to_bytes(8, 'big') + encode_frame(values, lengths)
+
+
+def rle_decompress_bytes(data: bytes) -> bytes:
+    """Decompress the binary RLE format back into bytes."""
+    if data[:len(RLE_MAGIC)] != RLE_MAGIC:
+        raise ValueError("Not a binary RLE stream")
+    view = memoryview(data)
+    total = int.from_bytes(view[4:12], 'big')
+    pos = 12
+    parts = []
+    while pos < len(view):
+        run_count = int.from_bytes(view[pos:pos + 8], 'big')
+        lengths_size = int.from_bytes(view[pos + 8:pos + 16], 'big')
+        pos += 16
+        values = np.frombuffer(view[pos:pos + run_count], dtype=np.uint8)
+        pos += run_count
+        lengths = decode_varints(view[pos:pos + lengths_size])
+        pos += lengths_size
+        parts.append(np.repeat(values, lengths.astype(np.int64)))
+    out = np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint8)
+    if len(out) != total:
+        raise ValueError("Binary RLE stream is corrupt")
+    return out.tobytes()
+
+
+def compress_stream(input_file: str, output_file: str, chunk_size: int = STREAM_CHUNK,
+                    profile=None):
+    """Compress a file of any size into the binary RLE format.
+
+    The input is read in fixed-size chunks into one reused buffer and every
+    chunk becomes a frame. The last run of a chunk is held back and merged
+    with the next chunk, so runs crossing chunk boundaries stay whole.
+    profile, an instrumentation.Profile, times the read, encode and write
+    of every chunk.
+    """
+    profile = as_profile(profile)
+    total = os.path.getsize(input_file)
+    buffer = bytearray(chunk_size)
+    carry_value = None
+    carry_length = 0
+    done = 0
+    with open(input_file, 'rb') as src, open(output_file, 'wb') as dst:
+        dst.write(RLE_MAGIC + total.to_bytes(8, 'big'))
+        while True:
+            with profile.stage('read'):
+                size = src.readinto(buffer)
+                profile.count(size)
+            if not size:
+                break
+            with profile.stage('encode', size):
+                values, lengths = find_runs(np.frombuffer(buffer, dtype=np.uint8, count=size))
+                if carry_value is not None:
+                    if values[0] == carry_value:
+                        lengths[0] += np.uint64(carry_length)
+                    else:
+                        values = np.concatenate(([carry_value], values)).astype(np.uint8)
+                        lengths = np.concatenate(([carry_length], lengths)).astype(np.uint64)
+                carry_value, carry_length = values[-1], int(lengths[-1])
+                frame = encode_frame(values[:-1], lengths[:-1]) if len(values) > 1 else b''
+            with profile.stage('write', len(frame)):
+                dst.write(frame)
+            done += size
+            profile.progress(done, total)
+        if carry_value is not None:
+            dst.write(encode_frame(np.array([carry_value], dtype=np.uint8),
+                                   np.array([carry_length], dtype=np.uint64)))
+
+
+def expand_runs(values: np.ndarray, lengths: np.ndarray, out: np.ndarray):
+    """Write runs into a preallocated array of exactly their total length."""
+    lengths = lengths.astype(np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    segment_start = 0
+    first_short = 0
+    for i in np.flatnonzero(lengths >= LONG_RUN):
+        # Short runs between two long ones are expanded together
+        if i > first_short:
+            out[segment_start:starts[i]] = np.repeat(values[first_short:i], lengths[first_short:i])
+        out[starts[i]:ends[i]] = values[i]
+        segment_start = ends[i]
+        first_short = i + 1
+    if first_short < len(values):
+        out[segment_start:] = np.repeat(values[first_short:], lengths[first_short:])
+
+
+def decompress_stream(input_file: str, output_file: str, profile=None):
+    """Decompress a binary RLE file frame by frame.
+
+    The output file is preallocated at its final size and memory-mapped, and
+    each frame is expanded straight into it, so memory use is bounded by the
+    largest frame rather than by the file. profile, an
+    instrumentation.Profile, times the read and expansion of every frame.
+    """
+    profile = as_profile(profile)
+    with open(input_file, 'rb') as src:
+        if src.read(len(RLE_MAGIC)) != RLE_MAGIC:
+            raise ValueError("Not a binary RLE file")
+        total = int.from_bytes(src.read(8), 'big')
+        if total == 0:
+            open(output_file, 'wb').close()
+            return
+        out = np.memmap(output_file, dtype=np.uint8, mode='w+', shape=(total,))
+        pos = 0
+        while True:
+            with profile.stage('read'):
+                header = src.read(16)
+                if not header:
+                    break
+                run_count = int.from_bytes(header[:8], 'big')
+                lengths_size = int.from_bytes(header[8:], 'big')
+                values = np.frombuffer(src.read(run_count), dtype=np.uint8)
+                lengths = src.read(lengths_size)
+                profile.count(16 + run_count + lengths_size)
+            with profile.stage('decode'):
+                lengths = decode_varints(lengths)
+                size = int(lengths.sum())
+                if pos + size > total:
+                    raise ValueError("Binary RLE file is corrupt")
+                expand_runs(values, lengths, out[pos:pos + size])
+                profile.count(size)
+            pos += size
+            profile.progress(pos, total)
+        with profile.stage('write', total):
+            out.flush()
+        del out
+    if pos != total:
+        raise ValueError("Binary RLE file is corrupt")
+
+
+def compress_file(input_file: str, output_file: str, binary: bool = False, profile=None):
+    """Compress the contents of the input file and save to the output file.
+
+    With binary=True the file is streamed as bytes into the binary RLE
+    format, which is safe for any content including digits. profile, an
+    instrumentation.Profile, records the time spent in each stage.
+    """
+    if binary:
+        compress_stream(input_file, output_file, profile=profile)
+        return
+    profile = as_profile(profile)
+
+    with profile.stage('read'), open(input_file, 'r') as f:
         original_data = f.read()
+        profile.count(len(original_data))
     
-    compressed_data = rle_compress(original_data)
+    with profile.stage('encode', len(original_data)):
+        compressed_data = rle_compress(original_data)
 
     # Check if compression is effective
     if len(compressed_data) < len(original_data):
-        with open(output_file, 'w') as f:
+        with profile.stage('write', len(compressed_data)), open(output_file, 'w') as f:
             f.write(compressed_data)
     else:
         # No compression if it's not reducing size
-        with open(output_file, 'w') as f:
+        with profile.stage('write', len(original_data)), open(output_file, 'w') as f:
             f.write(original_data)
 
-def decompress_file(input_file: str, output_file: str):
+def decompress_file(input_file: str, output_file: str, binary: bool = False, profile=None):
     """Decompress the contents of the input file and save to the output file."""
-    with open(input_file, 'r') as f:
+    if binary:
+        decompress_stream(input_file, output_file, profile)
+        return
+    profile = as_profile(profile)
+
+    with profile.stage('read'), open(input_file, 'r') as f:
         compressed_data = f.read()
+        profile.count(len(compressed_data))
 
-    decompressed_data = rle_decompress(compressed_data)
+    with profile.stage('decode', len(compressed_data)):
+        decompressed_data = rle_decompress(compressed_data)
 
-    with open(output_file, 'w') as f:
+    with profile.stage('write', len(decompressed_data)), open(output_file, 'w') as f:
         f.write(decompressed_data)
 
 # Example usage:
@@ -0,0 +1,356 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from naveen import huffman
+from prashant import lzw
+from bhanu import RLE
+from nitin import dct_image
+from instrumentation import Profile, as_profile, format_profile
+from result_cache import CACHE_SIZE, open_cache, format_cache_stats
+import codec_selection
+
+# A codec turns input_path into output_path with compress(input_path,
+# output_path) and back with decompress(input_path, output_path). Both also
+# take profile=, an instrumentation.Profile to record their stages in.
+# Compressed files get extension appended; decompressed files get it
+# stripped again, with restored_extension replacing the original suffix
+# for lossy codecs that write a different format (None keeps the name).
+# Codecs marked cacheable also take cache=, a result_cache.ResultCache of
+# earlier results, when compressing.
+Codec = namedtuple('Codec', ['name', 'extension', 'compress', 'decompress',
+                             'restored_extension', 'description', 'cacheable'])
+
+CODECS = {}
+
+# Codec name that picks a registered codec for each file from a sample of
+# it (see codec_selection)
+AUTO = 'auto'
+
+def register_codec(name, extension, compress, decompress, restored_extension=None, description='',
+                   cacheable=False):
+    """Add a codec to the registry under name and return it."""
+    if name in CODECS:
+        raise ValueError(f"Codec {name!r} is already registered")
+    CODECS[name] = Codec(name, extension, compress, decompress, restored_extension, description,
+                         cacheable)
+    return CODECS[name]
+
+def get_codec(name):
+    """Return the registered codec called name."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name!r}; choose from {', '.join(CODECS)}") from None
+
+def codec_for_path(path):
+    """Return the codec whose extension path has, or None."""
+    for codec in CODECS.values():
+        if path.endswith(codec.extension):
+            return codec
+    return None
+
+def _huffman_compress(input_path, output_path, profile=None, blocks=False, cache=None):
+    # Reusing the packed chunks of a cache beats packing them all again in parallel
+    if blocks and cache is None:
+        huffman.huffman_encode_blocks(input_path, output_path, binary=True, profile=profile)
+    else:
+        huffman.huffman_encode(input_path, output_path, binary=True, profile=profile, cache=cache)
+
+# Files are decoded one per run_batch worker already, so the decoders'
+# own pools are not started inside them
+def _huffman_decompress(input_path, output_path, profile=None):
+    huffman.huffman_decode(input_path, output_path, workers=1, profile=profile)
+
+def _lzw_decompress(input_path, output_path, profile=None):
+    lzw.lzw_decompress(input_path, output_path, workers=1, profile=profile)
+
+def _rle_compress(input_path, output_path, profile=None):
+    RLE.compress_file(input_path, output_path, binary=True, profile=profile)
+
+def _rle_decompress(input_path, output_path, profile=None):
+    RLE.decompress_file(input_path, output_path, binary=True, profile=profile)
+
+def _store(input_path, output_path, profile=None):
+    with as_profile(profile).stage('copy', os.path.getsize(input_path)):
+        shutil.copyfile(input_path, output_path)
+
+def _dct_image_compress(input_path, output_path, profile=None, cache=None):
+    dct_image.compress_image_tiled(input_path, output_path, subsampling='4:2:0', profile=profile,
+                                   cache=cache)
+
+# dct_video loads the C library and OpenCV on import, so it is only
+# imported once a video is coded
+def _dct_video_compress(input_path, output_path, profile=None):
+    from nitin import dct_video
+    dct_video.compress_video(input_path, output_path, native=True, profile=profile)
+
+def _dct_video_decompress(input_path, output_path, profile=None):
+    from nitin import dct_video
+    dct_video.decompress_video(input_path, output_path, profile=profile)
+
+register_codec('huffman', '.huf', _huffman_compress, _huffman_decompress,
+               description="Lossless canonical Huffman coding of any file", cacheable=True)
+register_codec('lzw', '.lzw', lzw.lzw_compress, _lzw_decompress,
+               description="Lossless variable-width LZW for UTF-8 text", cacheable=True)
+register_codec('RLE', '.rle', _rle_compress, _rle_decompress,
+               description="Lossless run-length coding of any file")
+register_codec('store', '.stored', _store, _store,
+               description="Copies files as they are, for input no codec shrinks")
+register_codec('dct_image', '.dcti', _dct_image_compress, dct_image.decompress_image, '.png',
+               description="Lossy 8x8 DCT image coding, decoded to PNG", cacheable=True)
+register_codec('dct_video', '.dctv', _dct_video_compress, _dct_video_decompress, '.mp4',
+               description="Lossy grayscale DCT video coding, decoded to mp4v")
+
+
+def collect_files(paths):
+    """Expand files and directory trees into (file, path relative to its root) pairs."""
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, names in os.walk(path):
+                subdirectories.sort()
+                for name in sorted(names):
+                    file_path = os.path.join(directory, name)
+                    yield file_path, os.path.relpath(file_path, path)
+        else:
+            yield path, os.path.basename(path)
+
+def unique_path(path, taken, extension=''):
+    """Return path, or path with -1, -2, ... before its suffix, so that it is
+    not in taken, the outputs of this run so far; the result is added to taken.
+
+    A trailing extension is kept with the suffix before it, so a.txt.huf
+    becomes a-1.txt.huf and still decompresses to a .txt name.
+    """
+    base = path[:-len(extension)] if extension and path.endswith(extension) else path
+    stem, suffix = os.path.splitext(base)
+    suffix += path[len(base):]
+    candidate = path
+    counter = 0
+    while candidate in taken:
+        counter += 1
+        candidate = f"{stem}-{counter}{suffix}"
+    taken.add(candidate)
+    return candidate
+
+def output_name(relative_path, codec, mode):
+    """Name the output of compressing or decompressing relative_path."""
+    if mode == 'compress':
+        return relative_path + codec.extension
+    if relative_path.endswith(codec.extension):
+        relative_path = relative_path[:-len(codec.extension)]
+    else:
+        relative_path += '.out'
+    if codec.restored_extension:
+        relative_path = os.path.splitext(relative_path)[0] + codec.restored_extension
+    return relative_path
+
+# Errors sampling a file can raise: reading it, decoding a damaged image or
+# video, or a missing image/video library
+SAMPLING_ERRORS = (OSError, ValueError, ImportError)
+
+def select_codec(input_path, lossy=False):
+    """Return the codec_selection.Selection for a file, or plain Huffman
+    coding if it cannot be sampled (it works on any file), with the reason
+    in its note. lossy lets images and video go to the DCT codecs."""
+    try:
+        return codec_selection.select_codec(input_path, lossy=lossy)
+    except SAMPLING_ERRORS as e:
+        return codec_selection.Selection('huffman', {}, None, {}, None,
+                                         f"could not sample ({type(e).__name__}: {e})")
+
+def plan_tasks(paths, mode, codec_name=None, output_dir=None, selections=None, lossy=False,
+               skip_existing=False, skipped=None):
+    """Yield (codec name, input path, output path, codec options) for every
+    file under paths.
+
+    Outputs mirror the input trees under output_dir, or sit next to their
+    inputs without it. When decompressing without codec_name, each file's
+    codec is picked from its extension and files with no known extension
+    are skipped; when compressing, files that already have a codec's
+    extension are skipped, so outputs of earlier runs are not compressed
+    again. With skip_existing, files whose output exists are skipped too.
+    (input path, reason) is appended to skipped, if given, for every file
+    skipped for either reason. With codec_name AUTO each file is sampled to
+    choose its codec and options, the lossy DCT codecs only if lossy is
+    set; the Selection is stored in selections, if given, under the input
+    path.
+    """
+    taken = set()
+    for input_path, relative_path in collect_files(paths):
+        options = {}
+        if mode == 'compress' and codec_for_path(input_path):
+            if skipped is not None:
+                skipped.append((input_path, f"already {codec_for_path(input_path).name} output"))
+            continue
+        if codec_name == AUTO:
+            selection = select_codec(input_path, lossy)
+            if selections is not None:
+                selections[input_path] = selection
+            codec, options = get_codec(selection.codec), selection.options
+        else:
+            codec = get_codec(codec_name) if codec_name else codec_for_path(input_path)
+        if codec is None:
+            continue
+        if output_dir is None:
+            relative_path = os.path.join(os.path.dirname(input_path), os.path.basename(relative_path))
+        else:
+            relative_path = os.path.join(output_dir, relative_path)
+        output_path = output_name(relative_path, codec, mode)
+        extension = codec.extension if mode == 'compress' else ''
+        output_path = unique_path(output_path, taken, extension)
+        if skip_existing and os.path.exists(output_path):
+            if skipped is not None:
+                skipped.append((input_path, f"{output_path} exists"))
+            continue
+        yield codec.name, input_path, output_path, options
+
+def run_task(mode, codec_name, input_path, output_path, profile=False, options=None, cache=None,
+             overwrite=False):
+    """Compress or decompress one file; returns (input, output, input size,
+    output size, error message or None, stage profile, cache counters) and
+    never raises. An existing output is an error unless overwrite is set.
+
+    options are passed to the codec as keyword arguments. With profile set
+    the stage profile is the run's Profile.as_dict(), else None. cache, a
+    result_cache.ResultCache, is handed to cacheable codecs when
+    compressing; the cache counters are then this task's share of its
+    ResultCache.stats(), else None.
+    """
+    if not overwrite and os.path.exists(output_path):
+        return (input_path, output_path, 0, 0,
+                "output exists (use --overwrite or --skip-existing)", None, None)
+    stages = Profile() if profile else None
+    counters = None
+    try:
+        codec = get_codec(codec_name)
+        options = dict(options or {})
+        if cache is not None and mode == 'compress' and codec.cacheable:
+            options['cache'] = cache
+            counters = cache.stats()
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        getattr(codec, mode)(input_path, output_path, profile=stages, **options)
+        if stages:
+            stages.finish()
+            stages = stages.as_dict()
+        if counters is not None:
+            counters = {name: count - counters[name] for name, count in cache.stats().items()}
+        return (input_path, output_path, os.path.getsize(input_path), os.path.getsize(output_path),
+                None, stages, counters)
+    except Exception as e:
+        # Output paths are unique to this task, so a partial file is ours
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        return input_path, output_path, 0, 0, f"{type(e).__name__}: {e}", None, None
+
+def run_batch(tasks, mode, jobs=None, profile=False, cache=None, overwrite=False):
+    """Run (codec name, input, output, options) tasks across a process pool.
+
+    Yields the run_task result of every file in task order; at most a few
+    tasks per worker are queued at once, so task lists of any length are
+    streamed. Each worker opens cache, if given, once (see
+    result_cache.open_cache).
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs) as pool:
+        items = ((mode, codec_name, input_path, output_path, profile, options, cache, overwrite)
+                 for codec_name, input_path, output_path, options in tasks)
+        yield from lzw.map_ordered(pool, run_task, items, 4 * jobs)
+
+
+def run_cli(mode, argv=None):
+    """Command-line entry point shared by compress.py and decompress.py."""
+    parser = argparse.ArgumentParser(
+        description=f"{mode.capitalize()} files and directory trees with a registered codec.",
+        epilog="Codecs: " + "; ".join(f"{c.name} ({c.extension}): {c.description}"
+                                      for c in CODECS.values()))
+    parser.add_argument('paths', nargs='+', help="files and directories to process")
+    parser.add_argument('-c', '--codec', choices=list(CODECS) + ([AUTO] if mode == 'compress' else []),
+                        required=(mode == 'compress'),
+                        help="codec to use" + (" (default: from each file's extension)"
+                                               if mode == 'decompress' else
+                                               f"; {AUTO} picks one per file from a sample of it"))
+    parser.add_argument('-o', '--output-dir',
+                        help="write outputs here, mirroring the input trees "
+                             "(default: next to each input)")
+    existing = parser.add_mutually_exclusive_group()
+    existing.add_argument('--overwrite', action='store_true',
+                          help="replace outputs that already exist (default: fail those files)")
+    existing.add_argument('--skip-existing', action='store_true',
+                          help="skip files whose output already exists")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write each file's per-stage wall time and bytes to FILE as "
+                             "JSON lines ('-' prints them after each file instead)")
+    if mode == 'compress':
+        parser.add_argument('--lossy', action='store_true',
+                            help=f"let {AUTO} pick the lossy DCT codecs for images and video "
+                                 "they are predicted to shrink")
+        parser.add_argument('--cache', metavar='DIR',
+                            help="reuse results of earlier runs stored in DIR, down to the "
+                                 "unchanged chunks of edited files, and store new ones there")
+        parser.add_argument('--cache-size', type=int, default=CACHE_SIZE >> 20, metavar='MB',
+                            help="size bound of the cache; the least recently used results "
+                                 "are deleted beyond it (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    done = failed = skip_count = total_in = total_out = 0
+    selections = {}
+    cache = open_cache(args.cache, args.cache_size << 20) if getattr(args, 'cache', None) else None
+    cache_totals = {}
+    skipped = []
+    tasks = plan_tasks(args.paths, mode, args.codec, args.output_dir, selections,
+                       getattr(args, 'lossy', False), args.skip_existing, skipped)
+    results = run_batch(tasks, mode, args.jobs, profile=bool(args.profile), cache=cache,
+                        overwrite=args.overwrite)
+    with open(args.profile, 'w') if args.profile and args.profile != '-' else \
+            contextlib.nullcontext() as profile_file:
+        for input_path, output_path, input_size, output_size, error, stages, counters in results:
+            # Planning runs ahead of the results, so skips are reported as they come up
+            for skipped_path, reason in skipped:
+                print(f"skipped {skipped_path}: {reason}")
+            skip_count += len(skipped)
+            skipped.clear()
+            selection = selections.pop(input_path, None)
+            if error:
+                failed += 1
+                print(f"FAILED {input_path}: {error}", file=sys.stderr)
+                continue
+            done += 1
+            total_in += input_size
+            total_out += output_size
+            print(f"{input_path} -> {output_path} ({input_size} -> {output_size} bytes)")
+            for name, count in (counters or {}).items():
+                cache_totals[name] = cache_totals.get(name, 0) + count
+            if selection:
+                # Predicted against actual, so the choice can be checked
+                actual = input_size / output_size if output_size else 0.0
+                print(f"  {AUTO}: {codec_selection.describe(selection)}; actual ratio {actual:.2f}")
+            if profile_file:
+                record = {'input': input_path, 'output': output_path,
+                          'input_bytes': input_size, 'output_bytes': output_size}
+                if selection:
+                    record.update(codec=selection.codec, predicted_ratio=selection.predicted_ratio)
+                if counters is not None:
+                    record['cache'] = counters
+                profile_file.write(json.dumps({**record, **stages}) + "\n")
+            elif stages:
+                print(format_profile(stages))
+    for skipped_path, reason in skipped:
+        print(f"skipped {skipped_path}: {reason}")
+    skip_count += len(skipped)
+    elapsed = time.perf_counter() - start
+    print(f"{done} files {mode}ed, {failed} failed, {skip_count} skipped, {total_in} -> "
+          f"{total_out} bytes in {elapsed:.2f}s")
+    if cache_totals:
+        print(format_cache_stats(cache_totals))
+    return 1 if failed else 0
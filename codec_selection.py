@@ -0,0 +1,328 @@
+import math
+import os
+from collections import namedtuple
+import numpy as np
+from naveen import huffman
+from prashant import lzw
+from bhanu import RLE
+
+# Automatic codec choice from a small sample of the input. Windows of
+# SAMPLE_WINDOW bytes are read at SAMPLE_WINDOWS evenly spaced places (files
+# no bigger than that are read whole) and each codec's output size is
+# predicted from statistics of the sample instead of a trial compression:
+#   huffman  the mean Huffman code length of the sampled byte frequencies,
+#            i.e. the order-0 entropy rounded up to whole-bit codes
+#   RLE      the bytes the sampled runs take as a value plus a varint length
+#   lzw      the LZW phrases (repeated substrings) in each window and in its
+#            first quarter; the growth between the two, fitted as
+#            c*log2(c) ~ n**delta, is extrapolated to the whole file
+# Images and video are left to the DCT codecs, predicted from a few tiles
+# or frames coded exactly.
+SAMPLE_WINDOW = 4096
+SAMPLE_WINDOWS = 8
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.ppm', '.pgm',
+                    '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.webm')
+
+# Size of the fixed parts of each codec's output
+HUFFMAN_HEADER = len(huffman.CANONICAL_MAGIC) + 1 + 256 + 8
+RLE_HEADER = len(RLE.RLE_MAGIC) + 8
+RLE_FRAME_HEADER = 16
+LZW_HEADER = len(lzw.LZW_MAGIC) + 1
+
+# Lossless codecs from fastest to slowest. A faster codec is chosen over
+# the best predicted one unless that is more than PREFER_FASTER better,
+# which also covers the error of the predictions on close calls.
+SPEED_ORDER = ('RLE', 'RLE-text', 'huffman', 'lzw')
+PREFER_FASTER = 0.10
+
+# Codecs chosen from by default; 'store' copies files none of the others
+# is predicted to shrink
+CANDIDATES = ('huffman', 'lzw', 'RLE', 'store')
+
+# Inputs at least this big are Huffman-coded in parallel blocks
+HUFFMAN_BLOCKS_FROM = 4 * huffman.BLOCK_SIZE
+
+# Side of the square tiles an image is sampled with, and how many per side
+IMAGE_TILE = 64
+IMAGE_TILES = 4
+
+# Frames a video is sampled with, and the quantization step compress_video uses
+VIDEO_SAMPLE_FRAMES = 3
+VIDEO_QUALITY = 5
+
+SampleStats = namedtuple('SampleStats', [
+    'size',           # bytes in the whole input
+    'sampled',        # bytes in the sample
+    'entropy',        # order-0 entropy of the sample, bits per byte
+    'code_length',    # mean Huffman code length for the sample, bits per byte
+    'run_length',     # mean run length in the sample, bytes
+    'rle_bytes',      # binary RLE output per sampled byte
+    'rle_text_bytes', # text RLE output per sampled byte
+    'phrase_length',  # mean LZW phrase length in a window, characters (0 if not text)
+    'phrase_growth',  # delta of the phrase count fit
+    'phrases',        # LZW phrases predicted for the whole input
+    'digits',         # whether the sample holds ASCII digits, which text RLE cannot code
+])
+
+# codec is a registered codec name and options the keyword arguments for
+# its compress function. predictions maps every candidate codec to its
+# predicted ratio; stats is the SampleStats, or None for media. note says
+# why a fallback codec was used instead of a sampled choice.
+Selection = namedtuple('Selection', ['codec', 'options', 'predicted_ratio', 'predictions', 'stats',
+                                     'note'], defaults=(None,))
+
+def read_windows(path, window=SAMPLE_WINDOW, count=SAMPLE_WINDOWS):
+    """Return the size of a file and the windows sampled from it."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size <= window * count:
+            return size, [f.read()]
+        windows = []
+        for index in range(count):
+            f.seek((size - window) * index // (count - 1))
+            windows.append(f.read(window))
+    return size, windows
+
+def decode_window(data, whole):
+    """Decode a sampled window as UTF-8, or return None if it is not text LZW can code.
+
+    A window cut out of a file may start or end inside a character, so up
+    to three bytes are dropped at either cut edge.
+    """
+    for start in range(1 if whole else 4):
+        for trim in range(1 if whole else 4):
+            try:
+                text = data[start:len(data) - trim].decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            return text if not text or max(text) <= '\uffff' else None
+    return None
+
+def lzw_phrases(text):
+    """Count the codes lzw_encode_chunks emits for text, without packing them."""
+    table = {}
+    lookup = table.get
+    code = lzw.FIRST_CODE
+    phrases = 0
+    prefix = -1
+    for symbol in map(ord, text):
+        if prefix < 0:
+            prefix = symbol
+            continue
+        key = (prefix << 16) | symbol
+        found = lookup(key)
+        if found is not None:
+            prefix = found
+            continue
+        phrases += 1
+        table[key] = code
+        code += 1
+        prefix = symbol
+    return phrases + (prefix >= 0)
+
+def lzw_bits(phrases, max_bits=lzw.MAX_CODE_BITS):
+    """Bits taken by that many LZW codes, with the code width growing from
+    MIN_CODE_BITS and a CLEAR_CODE each time the table fills."""
+    per_table = (1 << max_bits) - lzw.FIRST_CODE
+    tables, rest = divmod(int(phrases), per_table)
+    bits = tables * max_bits
+    for count in [per_table] * tables + [rest]:
+        code = lzw.FIRST_CODE
+        while count > 0:
+            width = max(lzw.MIN_CODE_BITS, code.bit_length())
+            step = min(count, (1 << width) - code)
+            bits += step * width
+            code += step
+            count -= step
+    return bits
+
+def extrapolate_phrases(phrases, quarter_phrases, window, total):
+    """Predict the LZW phrases of total characters from the phrases of a
+    window of that many characters and of its first quarter.
+
+    Returns the count and the fitted delta.
+    """
+    if total <= window or quarter_phrases < 2:
+        return phrases * total / max(window, 1), 1.0
+    f = lambda c: c * math.log2(c)
+    delta = min(1.0, max(0.5, math.log(f(phrases) / f(quarter_phrases)) / math.log(4)))
+    target = f(phrases) * (total / window) ** delta
+    # Solve c * log2(c) = target by fixed-point iteration
+    count = max(2.0, target / 16)
+    for _ in range(32):
+        count = target / max(1.0, math.log2(count))
+    return count, delta
+
+def analyze_windows(size, windows):
+    """Compute the SampleStats of windows sampled from an input of size bytes."""
+    data = np.frombuffer(b''.join(windows), dtype=np.uint8)
+    sampled = max(1, len(data))
+    counts = np.bincount(data, minlength=256)
+    p = counts[counts > 0] / sampled
+    entropy = float(-(p * np.log2(p)).sum())
+    frequencies = {symbol: int(count) for symbol, count in enumerate(counts) if count}
+    lengths = huffman.code_lengths(huffman.build_huffman_tree(frequencies)) if frequencies else {}
+    code_length = sum(frequencies[symbol] * length for symbol, length in lengths.items()) / sampled
+
+    runs = rle_bytes = rle_text_bytes = 0
+    for window in windows:
+        _, run_lengths = RLE.find_runs(np.frombuffer(window, dtype=np.uint8))
+        run_lengths = run_lengths.astype(np.float64)
+        runs += len(run_lengths)
+        # A value byte plus a LEB128 length, or a character plus its count in digits
+        rle_bytes += int((2 + np.floor(np.log2(run_lengths) / 7)).sum())
+        rle_text_bytes += int((1 + (run_lengths > 1) * (np.floor(np.log10(run_lengths)) + 1)).sum())
+
+    texts = [decode_window(window, len(windows) == 1) for window in windows]
+    phrase_length = phrase_growth = phrases = 0.0
+    if texts and all(text is not None for text in texts) and any(texts):
+        window_phrases = np.mean([lzw_phrases(text) for text in texts])
+        quarter_phrases = np.mean([lzw_phrases(text[:len(text) // 4]) for text in texts])
+        characters = np.mean([len(text) for text in texts])
+        phrase_length = characters / window_phrases
+        # Scale the file size by the sample's characters per byte
+        total = size * characters / np.mean([len(window) for window in windows])
+        phrases, phrase_growth = extrapolate_phrases(window_phrases, quarter_phrases,
+                                                     characters, total)
+    return SampleStats(size, len(data), entropy, code_length,
+                       len(data) / runs if runs else 0.0,
+                       rle_bytes / sampled, rle_text_bytes / sampled,
+                       phrase_length, phrase_growth, phrases,
+                       bool(((data >= ord('0')) & (data <= ord('9'))).any()))
+
+def analyze_file(path):
+    """Sample a file and return its SampleStats."""
+    return analyze_windows(*read_windows(path))
+
+def predict_sizes(stats):
+    """Predict the output size in bytes of each lossless codec from SampleStats.
+
+    lzw is left out unless the sample is UTF-8 text. 'RLE-text' is the text
+    format of RLE.compress_file, used by the GUI.
+    """
+    size = stats.size
+    rle_framing = RLE_HEADER + -(-size // RLE.STREAM_CHUNK) * RLE_FRAME_HEADER
+    sizes = {
+        'huffman': HUFFMAN_HEADER + math.ceil(size * stats.code_length / 8),
+        'RLE': rle_framing + stats.rle_bytes * size,
+        'RLE-text': stats.rle_text_bytes * size,
+    }
+    if stats.phrases:
+        sizes['lzw'] = LZW_HEADER + math.ceil(lzw_bits(stats.phrases) / 8)
+    return sizes
+
+def predict_image(path):
+    """Predict the dct_image output size of an image from a few coded tiles.
+
+    Up to IMAGE_TILES x IMAGE_TILES tiles spread over the image are placed
+    side by side and compressed as the registry does (quality 50, 4:2:0);
+    their bytes per pixel are scaled to the whole image. Uncompressed
+    images are memory-mapped, so only the tiles are read.
+    """
+    from nitin import dct_image
+    pixels = dct_image.open_pixels(path)
+    height, width = pixels.shape[:2]
+    tile = min(IMAGE_TILE, height, width)
+    if height <= tile * IMAGE_TILES and width <= tile * IMAGE_TILES:
+        sample = np.asarray(pixels)
+    else:
+        tops = np.linspace(0, height - tile, IMAGE_TILES).astype(int)
+        lefts = np.linspace(0, width - tile, IMAGE_TILES).astype(int)
+        sample = np.concatenate([pixels[top:top + tile, left:left + tile]
+                                 for top in tops for left in lefts], axis=1)
+    data = dct_image.compress_image_bytes(sample, 50, subsampling='4:2:0')
+    # Every plane of every strip carries two Huffman headers, which would
+    # swamp the few coded bytes of a small sample, so only the rest is scaled
+    planes = pixels.shape[2] if pixels.ndim == 3 else 1
+    strip_overhead = planes * 2 * (HUFFMAN_HEADER + 8)
+    strips = -(-height // dct_image.STRIP_HEIGHT)
+    coded = max(0, len(data) - strip_overhead)
+    return coded * (height * width) / (sample.shape[0] * sample.shape[1]) + strips * strip_overhead
+
+def predict_video(path):
+    """Predict the dct_video output size of a video from a few coded frames."""
+    import cv2
+    from nitin import dct_video
+    cap = cv2.VideoCapture(path)
+    try:
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        payloads = []
+        for index in np.linspace(0, max(0, count - 1), VIDEO_SAMPLE_FRAMES).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ret, frame = cap.read()
+            if not ret:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            levels = np.round(dct_video.dct_frame(gray) / VIDEO_QUALITY)
+            payloads.append(len(dct_video.encode_frame_payload(levels)))
+    finally:
+        cap.release()
+    if not payloads:
+        return None
+    header = len(dct_video.VIDEO_MAGIC) + 1 + 8 + 16 + 1
+    # Each frame also has a 17-byte index entry
+    return header + 4 + 8 + count * (np.mean(payloads) + 17)
+
+def select_codec(path, candidates=None, lossy=False):
+    """Pick the codec expected to compress the file at path best.
+
+    candidates limits the choice to those lossless codecs (default
+    CANDIDATES; 'RLE-text' is the text format the GUI uses). With 'store'
+    among them, files none of the others is predicted to shrink are stored
+    as they are. Only with lossy set do images and video go to the DCT
+    codecs, and only if those are predicted to shrink them. Returns a
+    Selection.
+    """
+    size = max(1, os.path.getsize(path))
+    extension = os.path.splitext(path)[1].lower()
+    media = {}
+    if lossy and extension in IMAGE_EXTENSIONS:
+        media['dct_image'] = size / predict_image(path)
+    elif lossy and extension in VIDEO_EXTENSIONS:
+        predicted = predict_video(path)
+        media['dct_video'] = size / predicted if predicted else None
+    for codec, ratio in media.items():
+        if ratio and ratio > 1:
+            return Selection(codec, {}, ratio, media, None)
+
+    stats = analyze_file(path)
+    sizes = predict_sizes(stats)
+    candidates = candidates or CANDIDATES
+    predictions = {codec: size / max(1, sizes[codec]) for codec in candidates if codec in sizes}
+    # Text RLE corrupts digits, and a sample without any only rules them
+    # out when it covers the whole file
+    if 'RLE-text' in predictions and (stats.digits or stats.sampled < stats.size):
+        del predictions['RLE-text']
+    if not predictions:
+        return Selection('store', {}, 1.0, media, stats, "no candidate codec can code the file")
+    best = max(predictions.values())
+    if best <= 1 and 'store' in candidates:
+        return Selection('store', {}, 1.0, {**media, **predictions}, stats)
+    codec = next(codec for codec in SPEED_ORDER
+                 if predictions.get(codec, 0) * (1 + PREFER_FASTER) >= best)
+    options = {}
+    if codec == 'huffman' and size >= HUFFMAN_BLOCKS_FROM:
+        options['blocks'] = True
+    return Selection(codec, options, predictions[codec], {**media, **predictions}, stats)
+
+def describe(selection):
+    """Return a one-line summary of a Selection and the sample it came from."""
+    text = f"{selection.codec}"
+    if selection.options:
+        text += " (" + ", ".join(f"{k}={v}" for k, v in selection.options.items()) + ")"
+    if selection.predicted_ratio:
+        text += f", predicted ratio {selection.predicted_ratio:.2f}"
+    others = [f"{codec} {ratio:.2f}" for codec, ratio in selection.predictions.items()
+              if codec != selection.codec and ratio]
+    if others:
+        text += " (" + ", ".join(others) + ")"
+    stats = selection.stats
+    if stats:
+        text += (f"; entropy {stats.entropy:.2f} bits/byte, mean run {stats.run_length:.1f} bytes")
+        if stats.phrase_length:
+            text += f", LZW phrase {stats.phrase_length:.1f} chars"
+    if selection.note:
+        text += f"; fallback: {selection.note}"
+    return text
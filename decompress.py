@@ -0,0 +1,5 @@
+import sys
+from codec_registry import run_cli
+
+if __name__ == '__main__':
+    sys.exit(run_cli('decompress'))
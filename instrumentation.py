@@ -0,0 +1,138 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+class Profile:
+    """Per-stage wall time, byte counts and progress of one codec run.
+
+    Codec entry points take profile=None; pass a Profile to see where the
+    time goes. Stages are named freely by each codec and may nest, so a
+    stage's time includes any stages run inside it. on_progress, if given,
+    is called as on_progress(stage, fraction) from the thread doing the
+    work whenever a stage starts or the codec reports progress; fraction
+    is the share of the whole run done so far, from 0 to 1.
+    """
+
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        # Stage name -> [seconds, bytes, calls], in the order stages first ran
+        self.stages = {}
+        self.current = None
+        self.fraction = 0.0
+        # Share of the whole run that progress reports are mapped onto
+        self.span = (0.0, 1.0)
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def _entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = [0.0, 0, 0]
+        return entry
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        """Time the body of a with block as stage name."""
+        previous = self.current
+        self.current = name
+        if self.on_progress:
+            self.on_progress(name, self.fraction)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            entry = self._entry(name)
+            entry[0] += time.perf_counter() - start
+            entry[1] += nbytes
+            entry[2] += 1
+            self.current = previous
+
+    def add(self, name, seconds=0.0, nbytes=0):
+        """Add time or bytes measured elsewhere (another thread or process) to a stage."""
+        entry = self._entry(name)
+        entry[0] += seconds
+        entry[1] += nbytes
+
+    def count(self, nbytes, name=None):
+        """Add bytes processed to stage name, by default the one running now."""
+        self._entry(name or self.current)[1] += nbytes
+
+    @contextmanager
+    def part(self, low, high):
+        """Map progress reported in the body onto low..high of the current span.
+
+        Lets a run made of several steps that each report 0 to 1 (compress
+        then decompress, say) show one progress from 0 to 1.
+        """
+        outer = self.span
+        width = outer[1] - outer[0]
+        self.span = (outer[0] + low * width, outer[0] + high * width)
+        try:
+            yield self
+        finally:
+            self.span = outer
+
+    def progress(self, done, total=1):
+        """Report that done out of total units of the current span are finished."""
+        low, high = self.span
+        self.fraction = low + (high - low) * (min(1.0, done / total) if total else 1.0)
+        if self.on_progress:
+            self.on_progress(self.current, self.fraction)
+
+    def finish(self):
+        """Mark the run complete and fix its total wall time."""
+        self.elapsed = time.perf_counter() - self.started
+        self.span = (0.0, 1.0)
+        self.progress(1)
+
+    def as_dict(self):
+        """Return the profile as plain data, for JSON or pickling."""
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        return {'seconds': elapsed,
+                'stages': [{'stage': name, 'seconds': seconds, 'bytes': nbytes, 'calls': calls}
+                           for name, (seconds, nbytes, calls) in self.stages.items()]}
+
+class NullProfile:
+    """Stands in for a Profile when none is given; every call does nothing."""
+
+    on_progress = None
+    _stage = nullcontext()
+
+    def stage(self, name, nbytes=0):
+        return self._stage
+
+    def part(self, low, high):
+        return self._stage
+
+    def add(self, name, seconds=0.0, nbytes=0):
+        pass
+
+    def count(self, nbytes, name=None):
+        pass
+
+    def progress(self, done, total=1):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_PROFILE = NullProfile()
+
+def as_profile(profile):
+    """Return profile, or the shared do-nothing profile for None."""
+    return NULL_PROFILE if profile is None else profile
+
+def format_profile(profile):
+    """Return a profile (a Profile or its as_dict) as text, one line per stage."""
+    if isinstance(profile, Profile):
+        profile = profile.as_dict()
+    total = profile['seconds']
+    lines = [f"total {total:.3f}s"]
+    for entry in profile['stages']:
+        seconds = entry['seconds']
+        line = f"  {entry['stage']:<16} {seconds:8.3f}s {100 * seconds / total if total else 0:5.1f}%"
+        if entry['bytes']:
+            line += f" {entry['bytes']} bytes"
+            if seconds:
+                line += f" ({entry['bytes'] / seconds / 1e6:.1f} MB/s)"
+        lines.append(line)
+    return "\n".join(lines)
@@ -1,7 +1,16 @@
 import heapq
-from collections import defaultdict
+import io
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrumentation import as_profile
+from result_cache import content_chunks, content_key
 
 class Node:
+    __slots__ = ('char', 'freq', 'left', 'right')
+
     def __init__(self, char, freq):
         self.char = char
         self.freq = freq
@@ -14,10 +23,13 @@ class Node:
 
 # Function to calculate frequency of characters in the text
 def calculate_frequencies(text):
-    frequency = defaultdict(int)
-    for char in text:
-        frequency[char] += 1
-    return frequency
+    # Counter keeps first-occurrence order, so the tree is built exactly as before
+    return Counter(text)
+
+# Function to calculate frequency of byte values in binary data
+def count_byte_frequencies(data):
+    counts = np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+    return {symbol: int(count) for symbol, count in enumerate(counts) if count}
 
 # Function to build the Huffman tree
 def build_huffman_tree(frequencies):
@@ -35,7 +47,9 @@ def build_huffman_tree(frequencies):
     return heap[0]
 
 # Function to generate Huffman codes from the tree
-def generate_codes(node, prefix='', codebook={}):
+def generate_codes(node, prefix='', codebook=None):
+    if codebook is None:
+        codebook = {}
     if node:
         if node.char is not None:
             codebook[node.char] = prefix
@@ -69,23 +83,27 @@ def save_compressed_file(encoded_text, codebook, filename):
             
         f.write(byte_array)
 
+# Function to read the text codebook header written by save_compressed_file
+def read_codebook(f):
+    codebook = {}
+    codebook_size = int.from_bytes(f.read(2), 'big')
+    for _ in range(codebook_size):
+        line = f.readline().decode('utf-8').strip()
+        a = line.split(' ', 1)
+        if len(a) == 2:
+            if a[0] == '\\n':
+                codebook[a[1]] = '\n'
+            else:
+                codebook[a[1]] = a[0]
+        else :
+            codebook[a[0]] = ' '
+    return codebook
+
 # Function to load the codebook from the compressed file
 def load_codebook(filename):
-    codebook = {}
     with open(filename, 'rb') as f:
-        codebook_size = int.from_bytes(f.read(2), 'big')
-        for _ in range(codebook_size):
-            line = f.readline().decode('utf-8').strip()
-            a = line.split(' ', 1)
-            if len(a) == 2:
-                if a[0] == '\\n':
-                    codebook[a[1]] = '\n'
-                else:
-                    codebook[a[1]] = a[0]
-            else :
-                codebook[a[0]] = ' '
+        codebook = read_codebook(f)
 
-        
         # Read the rest as binary encoded data
         encoded_data = f.read()
     
@@ -108,25 +126,611 @@ def decode_text(encoded_text, codebook):
             code = ''
     return ''.join(decoded_text)
 
-# Main function to perform Huffman encoding
-def huffman_encode(input_file, output_file):
-    with open(input_file, 'r') as f:
-        text = f.read()
-    frequencies = calculate_frequencies(text)
-    huffman_tree = build_huffman_tree(frequencies)
-    codebook = generate_codes(huffman_tree)
-    encoded_text = encode_text(text, codebook)
+# Magic bytes that open the canonical-code format; files without them use
+# the original text codebook header
+CANONICAL_MAGIC = b'HUFC'
+
+# Number of symbols turned into bits per step while packing
+PACK_CHUNK = 1 << 16
+
+# Function to get the code length of every symbol from the tree
+def code_lengths(node):
+    lengths = {}
+    stack = [(node, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if node.char is not None:
+            # A lone symbol still needs one bit per occurrence
+            lengths[node.char] = max(depth, 1)
+        else:
+            stack.append((node.left, depth + 1))
+            stack.append((node.right, depth + 1))
+    return lengths
+
+# Function to assign canonical Huffman codes from code lengths alone
+def canonical_codes(lengths):
+    codes = {}
+    code = 0
+    previous = 0
+    for symbol, length in sorted(lengths.items(), key=lambda item: (item[1], item[0])):
+        code <<= length - previous
+        codes[symbol] = (code, length)
+        code += 1
+        previous = length
+    return codes
+
+# Function to pack the codes of all symbols into bytes. Each chunk of
+# symbols becomes one bit string that is converted in a single int() call,
+# and the bits that do not fill a byte are carried into the next chunk.
+# progress, if given, is called as progress(symbols done, symbol count).
+def pack_codes(text, codes, progress=None):
+    bit_strings = {symbol: format(code, f'0{length}b') for symbol, (code, length) in codes.items()}
+    lookup = bit_strings.__getitem__
+    packed = bytearray()
+    carry = ''
+    bit_count = 0
+    for start in range(0, len(text), PACK_CHUNK):
+        if progress:
+            progress(start, len(text))
+        bits = carry + ''.join(map(lookup, text[start:start + PACK_CHUNK]))
+        whole = len(bits) - len(bits) % 8
+        if whole:
+            packed += int(bits[:whole], 2).to_bytes(whole // 8, 'big')
+        bit_count += whole
+        carry = bits[whole:]
+    if carry:
+        packed.append(int(carry.ljust(8, '0'), 2))
+        bit_count += len(carry)
+    return packed, bit_count
+
+# Header flags: the payload is split into independently decodable blocks,
+# and the symbols are byte values rather than characters
+FLAG_BLOCKS = 0x01
+FLAG_BINARY = 0x02
+
+# Function to write the canonical header. Text symbols are listed in
+# canonical order as a 3-byte code point plus a 1-byte code length; binary
+# files store one code length per byte value, 0 for unused values.
+def write_canonical_header(f, lengths, flags=0):
+    f.write(CANONICAL_MAGIC)
+    f.write(bytes([flags]))
+    if flags & FLAG_BINARY:
+        f.write(bytes(lengths.get(symbol, 0) for symbol in range(256)))
+        return
+    f.write(len(lengths).to_bytes(4, 'big'))
+    for symbol, length in sorted(lengths.items(), key=lambda item: (item[1], item[0])):
+        f.write(ord(symbol).to_bytes(3, 'big') + bytes([length]))
+
+# Function to read the canonical header back into code lengths
+def read_canonical_header(f):
+    flags = f.read(1)[0]
+    if flags & FLAG_BINARY:
+        return flags, {symbol: length for symbol, length in enumerate(f.read(256)) if length}
+    symbol_count = int.from_bytes(f.read(4), 'big')
+    table = f.read(4 * symbol_count)
+    lengths = {}
+    for i in range(0, len(table), 4):
+        lengths[chr(int.from_bytes(table[i:i + 3], 'big'))] = table[i + 3]
+    return flags, lengths
+
+# Function to encode text (or bytes when binary is set) and write it to f
+# in the canonical format
+def write_encoded(f, data, binary=False, profile=None):
+    profile = as_profile(profile)
+    with profile.stage('count', len(data)):
+        frequencies = count_byte_frequencies(data) if binary else calculate_frequencies(data)
+    with profile.stage('tree'):
+        lengths = code_lengths(build_huffman_tree(frequencies)) if frequencies else {}
+        codes = canonical_codes(lengths)
+    with profile.stage('pack', len(data)):
+        packed, bit_count = pack_codes(data, codes, profile.progress)
+
+    with profile.stage('write', len(packed)):
+        write_canonical_header(f, lengths, FLAG_BINARY if binary else 0)
+        f.write(bit_count.to_bytes(8, 'big'))
+        f.write(packed)
+
+# Average symbols per chunk when encoding with a cache
+CACHE_CHUNK = 1 << 18
+
+# Codes from an earlier run are kept while they make the output at most
+# this much bigger than new optimal codes would, so that unchanged chunks
+# can be copied instead of packed again
+CACHE_CODE_SLACK = 0.01
+
+# Function to get the symbol that comes last in canonical order
+def last_symbol(lengths):
+    return max(lengths.items(), key=lambda item: (item[1], item[0]))[0]
+
+# Function to pick a symbol that does not occur to reserve a code for in
+# cached code tables: the highest code point, or the highest unused byte
+# value (None if every byte occurs). As the last symbol in canonical order
+# its code is where extend_lengths later adds new symbols.
+def reserve_symbol(frequencies, binary):
+    symbol = 255 if binary else 0x10FFFF
+    while symbol >= 0 and (symbol if binary else chr(symbol)) in frequencies:
+        symbol -= 1
+    if symbol < 0:
+        return None
+    return symbol if binary else chr(symbol)
+
+# Function to give symbols missing from code lengths codes of their own
+# while keeping every other canonical code as it is. The code of the last
+# symbol in canonical order (the reserved one, see reserve_symbol) becomes
+# the root of a subtree just deep enough to hold it and the new symbols.
+def extend_lengths(lengths, symbols):
+    last = last_symbol(lengths)
+    length = lengths[last] + len(symbols).bit_length()
+    extended = dict(lengths)
+    for symbol in (last, *symbols):
+        extended[symbol] = length
+    return extended
+
+# Function to append packed bits that need not fill their last byte to
+# out. The bits of the previous call that did not fill a byte come in as
+# (carry, carry_bits) and the new leftover is returned the same way.
+def append_bits(out, packed, bit_count, carry, carry_bits):
+    value = (carry << bit_count) | (int.from_bytes(packed, 'big') >> (8 * len(packed) - bit_count))
+    bit_count += carry_bits
+    tail = bit_count % 8
+    out += (value >> tail).to_bytes(bit_count // 8, 'big')
+    return value & ((1 << tail) - 1), tail
+
+# Function to get the canonical header of code lengths and its cache key
+def lengths_entry(lengths, binary):
+    header = io.BytesIO()
+    write_canonical_header(header, lengths, FLAG_BINARY if binary else 0)
+    header = header.getvalue()
+    return content_key('huffman-code', {}, header), header
+
+# Function to serialize a cached chunk: the key of the code lengths it was
+# packed with, its bit count, its symbols and their counts, then its bits
+def write_chunk_entry(lengths_key, frequencies, bit_count, packed, binary):
+    symbols = list(frequencies) if binary else list(map(ord, frequencies))
+    return (bytes.fromhex(lengths_key) + bit_count.to_bytes(8, 'big')
+            + len(symbols).to_bytes(4, 'big') + np.array(symbols, dtype='>u4').tobytes()
+            + np.array(list(frequencies.values()), dtype='>u8').tobytes() + bytes(packed))
+
+# Function to read a chunk written by write_chunk_entry back into
+# (lengths key, frequencies, bit count, packed bits)
+def read_chunk_entry(entry, binary):
+    count = int.from_bytes(entry[40:44], 'big')
+    symbols = np.frombuffer(entry, '>u4', count, 44).tolist()
+    counts = np.frombuffer(entry, '>u8', count, 44 + 4 * count).tolist()
+    frequencies = dict(zip(symbols if binary else map(chr, symbols), counts))
+    return entry[:32].hex(), frequencies, int.from_bytes(entry[32:40], 'big'), entry[44 + 12 * count:]
+
+# Function to encode like write_encoded, reusing the counts and packed bits
+# of content-defined chunks stored in cache, a result_cache.ResultCache.
+# Code tables hold a reserved code for a symbol that does not occur (see
+# reserve_symbol), which costs the rarest symbol one more bit. The codes
+# of an earlier run are kept if they are nearly as good (see
+# CACHE_CODE_SLACK), with symbols new since that run given codes under
+# the reserved one, so an edit only has the chunks it touches packed again.
+def write_encoded_cached(f, data, cache, binary=False, profile=None, chunk_size=CACHE_CHUNK):
+    profile = as_profile(profile)
+    with profile.stage('cache', len(data)):
+        chunks = list(content_chunks([data], chunk_size))
+        keys = [content_key('huffman', {'binary': binary}, chunk) for chunk in chunks]
+        entries = [cache.read(key) for key in keys]
+        entries = [entry and read_chunk_entry(entry, binary) for entry in entries]
+
+    count = count_byte_frequencies if binary else calculate_frequencies
+    with profile.stage('count'):
+        chunk_frequencies = []
+        frequencies = Counter()
+        for chunk, entry in zip(chunks, entries):
+            if entry:
+                chunk_frequencies.append(entry[1])
+            else:
+                chunk_frequencies.append(count(chunk))
+                profile.count(len(chunk))
+            frequencies.update(chunk_frequencies[-1])
+        if binary:
+            # In byte order, as count_byte_frequencies gives them
+            frequencies = dict(sorted(frequencies.items()))
+    with profile.stage('tree'):
+        lengths = code_lengths(build_huffman_tree(frequencies)) if frequencies else {}
+        reserve = reserve_symbol(frequencies, binary)
+        if lengths and reserve is not None:
+            lengths = extend_lengths(lengths, [reserve])
+        lengths_key, header = lengths_entry(lengths, binary)
+        # Chunks packed with base_key can be copied unless they hold a
+        # symbol in changed, whose code differs from the one used now
+        base_key, changed = lengths_key, set()
+        previous = Counter(entry[0] for entry in entries if entry).most_common(1)
+        if previous and previous[0][0] != lengths_key:
+            old_header = cache.read(previous[0][0])
+            if old_header:
+                old_lengths = read_canonical_header(io.BytesIO(old_header[len(CANONICAL_MAGIC):]))[1]
+                old_changed = set()
+                new_symbols = [symbol for symbol in frequencies if symbol not in old_lengths]
+                if new_symbols:
+                    old_changed = {last_symbol(old_lengths)}
+                    old_lengths = extend_lengths(old_lengths, new_symbols)
+                best = sum(freq * lengths[symbol] for symbol, freq in frequencies.items())
+                if sum(freq * old_lengths[symbol] for symbol, freq in frequencies.items()) \
+                        <= best * (1 + CACHE_CODE_SLACK) and \
+                        max(old_lengths.values()) <= max(2 * LOOKUP_BITS, *lengths.values()):
+                    base_key, changed = previous[0][0], old_changed
+                    lengths = old_lengths
+                    lengths_key, header = (lengths_entry(lengths, binary) if new_symbols
+                                           else (base_key, old_header))
+        cache.put(lengths_key, header)
+        codes = canonical_codes(lengths)
+
+    packed = bytearray()
+    bit_count = 0
+    carry = carry_bits = 0
+    done = 0
+    with profile.stage('pack'):
+        for chunk, key, entry, chunk_frequency in zip(chunks, keys, entries, chunk_frequencies):
+            reused = bool(entry) and (entry[0] == lengths_key or
+                                      entry[0] == base_key and changed.isdisjoint(entry[1]))
+            cache.count(reused, len(chunk))
+            if reused:
+                chunk_bits, chunk_packed = entry[2], entry[3]
+            else:
+                chunk_packed, chunk_bits = pack_codes(chunk, codes)
+                cache.put(key, write_chunk_entry(lengths_key, chunk_frequency, chunk_bits,
+                                                 chunk_packed, binary))
+                profile.count(len(chunk))
+            carry, carry_bits = append_bits(packed, chunk_packed, chunk_bits, carry, carry_bits)
+            bit_count += chunk_bits
+            done += len(chunk)
+            profile.progress(done, len(data))
+        if carry_bits:
+            packed.append(carry << (8 - carry_bits))
+
+    with profile.stage('write', len(packed)):
+        f.write(header)
+        f.write(bit_count.to_bytes(8, 'big'))
+        f.write(packed)
+
+# Main function to perform Huffman encoding. profile, an
+# instrumentation.Profile, records the time spent in each stage. With
+# cache, a result_cache.ResultCache, chunks coded by earlier runs are
+# reused (see write_encoded_cached).
+def huffman_encode(input_file, output_file, binary=False, profile=None, cache=None):
+    profile = as_profile(profile)
+    with profile.stage('read'), open(input_file, 'rb' if binary else 'r') as f:
+        data = f.read()
+        profile.count(len(data))
+
+    with open(output_file, 'wb') as f:
+        if cache is None:
+            write_encoded(f, data, binary, profile)
+        else:
+            write_encoded_cached(f, data, cache, binary, profile)
+
+# Function to Huffman-compress a bytes object in memory
+def huffman_compress_bytes(data):
+    buffer = io.BytesIO()
+    write_encoded(buffer, bytes(data), binary=True)
+    return buffer.getvalue()
+
+
+# Function to compute the size huffman_compress_bytes gives data from its
+# byte frequencies and code lengths alone, without packing any codes
+def huffman_compressed_size(data):
+    frequencies = count_byte_frequencies(bytes(data))
+    lengths = code_lengths(build_huffman_tree(frequencies)) if frequencies else {}
+    bit_count = sum(count * lengths[symbol] for symbol, count in frequencies.items())
+    return len(CANONICAL_MAGIC) + 1 + 256 + 8 + -(-bit_count // 8)
+
+
+# Number of bits resolved by the first-level decode table; longer codes
+# fall through to a second-level table keyed on the following bits
+LOOKUP_BITS = 12
+
+class DecodeTable:
+    def __init__(self, codes, lookup_bits=LOOKUP_BITS):
+        # codes is an iterable of (symbol, code, length) with code as an int.
+        # Longest first, so a shorter code wins any prefix it shares.
+        codes = sorted((entry for entry in codes if entry[2] > 0),
+                       key=lambda entry: -entry[2])
+        self.max_len = max((length for _, _, length in codes), default=0)
+        self.bits = lookup_bits
+        # Bits that must be buffered before each lookup
+        self.peek_bits = max(self.max_len, self.bits)
+        size = 1 << self.bits
+        self.symbols = [None] * size
+        self.lengths = [0] * size
+        self.subtables = [None] * size
+
+        long_codes = defaultdict(list)
+        for symbol, code, length in codes:
+            if length <= self.bits:
+                # Every index that starts with this code resolves to it
+                shift = self.bits - length
+                start = code << shift
+                for index in range(start, start + (1 << shift)):
+                    self.symbols[index] = symbol
+                    self.lengths[index] = length
+            else:
+                long_codes[code >> (length - self.bits)].append((symbol, code, length))
+
+        for prefix, entries in long_codes.items():
+            sub_bits = max(length for _, _, length in entries) - self.bits
+            sub_symbols = [None] * (1 << sub_bits)
+            sub_lengths = [0] * (1 << sub_bits)
+            for symbol, code, length in entries:
+                rest = length - self.bits
+                shift = sub_bits - rest
+                start = (code & ((1 << rest) - 1)) << shift
+                for index in range(start, start + (1 << shift)):
+                    sub_symbols[index] = symbol
+                    sub_lengths[index] = length
+            self.subtables[prefix] = (sub_bits, sub_symbols, sub_lengths)
+
+        # Multi-symbol entries: every complete code that fits in the lookup
+        # window is resolved at once, so short codes cost one lookup per
+        # window instead of one per symbol
+        self.runs = [None] * size
+        self.run_bits = [0] * size
+        mask = size - 1
+        for index in range(size):
+            run = []
+            used = 0
+            while True:
+                peek = (index << used) & mask
+                length = self.lengths[peek]
+                if not length or used + length > self.bits:
+                    break
+                run.append(self.symbols[peek])
+                used += length
+            if run:
+                self.runs[index] = run
+                self.run_bits[index] = used
+
+    # Build a table from canonical code lengths
+    @classmethod
+    def from_lengths(cls, lengths, lookup_bits=LOOKUP_BITS):
+        return cls(((symbol, code, length)
+                    for symbol, (code, length) in canonical_codes(lengths).items()), lookup_bits)
+
+    # Build a table from a text codebook that maps '0'/'1' strings to symbols
+    @classmethod
+    def from_codebook(cls, codebook, lookup_bits=LOOKUP_BITS):
+        # Entries mangled by the text header (whitespace symbols) can never
+        # match a bit sequence, so they are left out
+        return cls(((symbol, int(code, 2), len(code))
+                    for code, symbol in codebook.items()
+                    if code and not code.strip('01')), lookup_bits)
+
+# Function to decode packed bytes with a decode table. Decoding stops after
+# bit_count bits or once fewer bits remain than the next code needs.
+# progress, if given, is called as progress(bytes done, byte count) about
+# every PACK_CHUNK bytes.
+def decode_bytes(data, table, bit_count=None, progress=None):
+    decoded = []
+    if table.max_len == 0:
+        return decoded
+    if bit_count is None:
+        bit_count = len(data) * 8
+    append = decoded.append
+    extend = decoded.extend
+    peek_bits = table.peek_bits
+    bits = table.bits
+    runs = table.runs
+    run_bits = table.run_bits
+    symbols = table.symbols
+    lengths = table.lengths
+    subtables = table.subtables
+
+    # Zero tail so refills never run past the end of the buffer
+    size = len(data)
+    data = bytes(data) + bytes(peek_bits // 8 + 8)
+    acc = 0
+    acc_bits = 0
+    pos = 0
+    report = PACK_CHUNK if progress else len(data)
+    remaining = bit_count
+    while remaining > 0:
+        if acc_bits < peek_bits:
+            if pos >= report:
+                progress(pos, size)
+                report += PACK_CHUNK
+            while acc_bits < peek_bits:
+                acc = (acc << 56) | int.from_bytes(data[pos:pos + 7], 'big')
+                pos += 7
+                acc_bits += 56
+        index = acc >> (acc_bits - bits)
+        length = run_bits[index]
+        if length and length <= remaining:
+            extend(runs[index])
+        else:
+            # Single symbol: a code longer than the window, or the stream tail
+            length = lengths[index]
+            if length:
+                symbol = symbols[index]
+            else:
+                sub = subtables[index]
+                if sub is None:
+                    raise ValueError("Invalid Huffman code in compressed data")
+                sub_bits, sub_symbols, sub_lengths = sub
+                sub_index = (acc >> (acc_bits - bits - sub_bits)) & ((1 << sub_bits) - 1)
+                length = sub_lengths[sub_index]
+                if not length:
+                    raise ValueError("Invalid Huffman code in compressed data")
+                symbol = sub_symbols[sub_index]
+            if length > remaining:
+                break
+            append(symbol)
+        remaining -= length
+        acc_bits -= length
+        acc &= (1 << acc_bits) - 1
+    return decoded
+
+# Function to join decoded symbols back into text or bytes
+def join_symbols(decoded, binary):
+    return bytes(decoded) if binary else ''.join(decoded)
+
+# Main function to perform Huffman decoding. profile, an
+# instrumentation.Profile, records the time spent in each stage.
+def huffman_decode(compressed_file, output_file, workers=None, profile=None):
+    profile = as_profile(profile)
+    binary = False
+    with open(compressed_file, 'rb') as f:
+        if f.read(len(CANONICAL_MAGIC)) == CANONICAL_MAGIC:
+            flags, lengths = read_canonical_header(f)
+            if flags & FLAG_BLOCKS:
+                f.seek(0)
+                decode_blocks(f, output_file, workers, profile)
+                return
+            binary = bool(flags & FLAG_BINARY)
+            bit_count = int.from_bytes(f.read(8), 'big')
+            with profile.stage('table'):
+                table = DecodeTable.from_lengths(lengths)
+        else:
+            f.seek(0)
+            with profile.stage('table'):
+                table = DecodeTable.from_codebook(read_codebook(f))
+            bit_count = None
+        with profile.stage('read'):
+            encoded_data = f.read()
+            profile.count(len(encoded_data))
+    with profile.stage('decode', len(encoded_data)):
+        decoded = join_symbols(decode_bytes(encoded_data, table, bit_count, profile.progress), binary)
+
+    with profile.stage('write', len(decoded)), open(output_file, 'wb' if binary else 'w') as f:
+        f.write(decoded)
+
+# Function to decompress the output of huffman_compress_bytes in memory
+def huffman_decompress_bytes(data):
+    f = io.BytesIO(data)
+    if f.read(len(CANONICAL_MAGIC)) != CANONICAL_MAGIC:
+        raise ValueError("Not a canonical Huffman stream")
+    flags, lengths = read_canonical_header(f)
+    if flags & FLAG_BLOCKS or not flags & FLAG_BINARY:
+        raise ValueError("Only single-block binary streams can be decompressed in memory")
+    bit_count = int.from_bytes(f.read(8), 'big')
+    return bytes(decode_bytes(f.read(), DecodeTable.from_lengths(lengths), bit_count))
+
+
+# Default number of symbols per block in block mode
+BLOCK_SIZE = 1 << 21
+
+# Per-process state set up once by the pool initializers
+_worker_codes = None
+_worker_table = None
+_worker_binary = False
+
+def _init_encode_worker(lengths):
+    global _worker_codes
+    _worker_codes = canonical_codes(lengths)
+
+def _init_decode_worker(lengths, binary):
+    global _worker_table, _worker_binary
+    _worker_table = DecodeTable.from_lengths(lengths)
+    _worker_binary = binary
+
+def _encode_block(block):
+    packed, bit_count = pack_codes(block, _worker_codes)
+    return bytes(packed), bit_count
+
+def _decode_block(args):
+    data, bit_count = args
+    return join_symbols(decode_bytes(data, _worker_table, bit_count), _worker_binary)
+
+# Function to write the block index: the block count, then the payload
+# offset and bit count of every block
+def write_block_index(f, entries):
+    f.write(len(entries).to_bytes(4, 'big'))
+    for offset, bit_count in entries:
+        f.write(offset.to_bytes(8, 'big') + bit_count.to_bytes(8, 'big'))
+
+# Function to read the header and block index of a block-mode file. Returns
+# the flags, code lengths, (offset, bit count) entries and where the payload starts.
+def read_block_index(f):
+    if f.read(len(CANONICAL_MAGIC)) != CANONICAL_MAGIC:
+        raise ValueError("Not a canonical Huffman file")
+    flags, lengths = read_canonical_header(f)
+    if not flags & FLAG_BLOCKS:
+        raise ValueError("Huffman file was not written in block mode")
+    block_count = int.from_bytes(f.read(4), 'big')
+    index = f.read(16 * block_count)
+    entries = [(int.from_bytes(index[i:i + 8], 'big'), int.from_bytes(index[i + 8:i + 16], 'big'))
+               for i in range(0, len(index), 16)]
+    return flags, lengths, entries, f.tell()
+
+# Main function to perform block-parallel Huffman encoding. All blocks share
+# one codebook; each starts on a byte boundary so it can be decoded alone.
+def huffman_encode_blocks(input_file, output_file, block_size=BLOCK_SIZE, workers=None, binary=False,
+                          profile=None):
+    profile = as_profile(profile)
+    with profile.stage('read'), open(input_file, 'rb' if binary else 'r') as f:
+        data = f.read()
+        profile.count(len(data))
+    blocks = [data[start:start + block_size] for start in range(0, len(data), block_size)]
+    count = count_byte_frequencies if binary else calculate_frequencies
+
+    with profile.stage('count', len(data)), ProcessPoolExecutor(max_workers=workers) as pool:
+        frequencies = defaultdict(int)
+        for block_frequencies in pool.map(count, blocks):
+            for char, freq in block_frequencies.items():
+                frequencies[char] += freq
+    with profile.stage('tree'):
+        lengths = code_lengths(build_huffman_tree(frequencies)) if frequencies else {}
+
+    with profile.stage('pack', len(data)), ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_encode_worker, initargs=(lengths,)) as pool:
+        encoded = []
+        for packed in pool.map(_encode_block, blocks):
+            encoded.append(packed)
+            profile.progress(len(encoded), len(blocks))
+
+    entries = []
+    offset = 0
+    for packed, bit_count in encoded:
+        entries.append((offset, bit_count))
+        offset += len(packed)
+
+    with profile.stage('write', offset), open(output_file, 'wb') as f:
+        write_canonical_header(f, lengths, FLAG_BLOCKS | (FLAG_BINARY if binary else 0))
+        write_block_index(f, entries)
+        for packed, _ in encoded:
+            f.write(packed)
+
+# Function to decode every block of a block-mode file in parallel and write
+# them out in order. A single block, or a single worker, is decoded inline
+# without starting a pool; callers already running in a pool worker pass
+# workers=1.
+def decode_blocks(f, output_file, workers=None, profile=None):
+    profile = as_profile(profile)
+    flags, lengths, entries, payload_start = read_block_index(f)
+    binary = bool(flags & FLAG_BINARY)
 
-    save_compressed_file(encoded_text, codebook, output_file)
+    def block_data():
+        for offset, bit_count in entries:
+            f.seek(payload_start + offset)
+            yield f.read((bit_count + 7) // 8), bit_count
 
+    def write_blocks(decoded_blocks):
+        for done, decoded in enumerate(decoded_blocks, 1):
+            out.write(decoded)
+            profile.count(len(decoded))
+            profile.progress(done, len(entries))
 
-# Main function to perform Huffman decoding
-def huffman_decode(compressed_file, output_file):
-    codebook, encoded_text = load_codebook(compressed_file)
-    decoded_text = decode_text(encoded_text, codebook)
+    with profile.stage('decode'), open(output_file, 'wb' if binary else 'w') as out:
+        if workers == 1 or len(entries) < 2:
+            _init_decode_worker(lengths, binary)
+            write_blocks(map(_decode_block, block_data()))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker,
+                                     initargs=(lengths, binary)) as pool:
+                write_blocks(pool.map(_decode_block, block_data()))
 
-    with open(output_file, 'w') as f:
-        f.write(decoded_text)
+# Function to decode a single block of a block-mode file without reading
+# the rest of the payload
+def huffman_decode_block(compressed_file, block):
+    with open(compressed_file, 'rb') as f:
+        flags, lengths, entries, payload_start = read_block_index(f)
+        offset, bit_count = entries[block]
+        f.seek(payload_start + offset)
+        data = f.read((bit_count + 7) // 8)
+    decoded = decode_bytes(data, DecodeTable.from_lengths(lengths), bit_count)
+    return join_symbols(decoded, flags & FLAG_BINARY)
 
 
 
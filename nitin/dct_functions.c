@@ -1,5 +1,6 @@
 #include <math.h>
 #include <stdlib.h>
+#include <string.h>
 
 #define PI 3.14159265358979323846
 
@@ -9,9 +10,123 @@
 #define EXPORT
 #endif
 
+// Build: make, in the repository root (see the Makefile). Contraction of
+// multiply-adds into FMA is turned off there so that the direct transforms
+// below keep their exact results whatever the target CPU.
+
+// Values of each group of outputs the direct transforms sum side by side
+#define DIRECT_GROUP 16
+
+// Fill table[u*N + x] with the orthonormal DCT basis c(u) cos((2x+1)u pi / 2N)
+static void dct_table(double *table, int N) {
+    for (int u = 0; u < N; u++) {
+        double c = (u == 0) ? sqrt(1.0 / N) : sqrt(2.0 / N);
+        for (int x = 0; x < N; x++) {
+            table[u*N + x] = c * cos((2*x + 1) * u * PI / (2*N));
+        }
+    }
+}
+
+// Tables of the direct transforms the library started with.
+// basis[(i*N + j)*M*N + u*N + v] holds cos((2i+1)u pi/2M) cos((2j+1)v pi/2N)
+// and basis_t the same with the index pairs swapped. scale[u*N + v] is
+// 2/sqrt(MN) c(u) c(v) and weight[u*N + v] is c(u) c(v), with c(0) = 1/sqrt(2)
+// and 1 otherwise. Every value is computed with the same operations as the
+// original loops did, so sums of them in the same order match bit for bit.
+static void direct_tables(double *basis, double *basis_t, double *scale, double *weight,
+                          int M, int N) {
+    int K = M*N;
+    for (int i = 0; i < M; i++) {
+        for (int j = 0; j < N; j++) {
+            for (int u = 0; u < M; u++) {
+                for (int v = 0; v < N; v++) {
+                    double cos_term = cos((2*i + 1) * u * PI / (2*M)) * cos((2*j + 1) * v * PI / (2*N));
+                    basis[(size_t)(i*N + j)*K + u*N + v] = cos_term;
+                    basis_t[(size_t)(u*N + v)*K + i*N + j] = cos_term;
+                }
+            }
+        }
+    }
+    for (int u = 0; u < M; u++) {
+        for (int v = 0; v < N; v++) {
+            double cu = (u == 0) ? 1/sqrt(2) : 1;
+            double cv = (v == 0) ? 1/sqrt(2) : 1;
+            scale[u*N + v] = (2.0 / sqrt(M*N)) * cu * cv;
+            weight[u*N + v] = cu * cv;
+        }
+    }
+}
+
+// output[k] = sum over p of input[p] * table[p*K + k], each sum taken in
+// order of p as the original loops did. Inputs that are zero add nothing,
+// so the others are listed first in nonzero (K scratch ints). Then
+// DIRECT_GROUP outputs are summed side by side in registers, which
+// vectorizes without reordering any sum.
+static void direct_sums(const double *restrict input, double *restrict output,
+                        const double *restrict table, int *restrict nonzero, int K) {
+    int count = 0;
+    for (int p = 0; p < K; p++) {
+        nonzero[count] = p;
+        count += input[p] != 0.0;
+    }
+    int k0 = 0;
+    for (; k0 + DIRECT_GROUP <= K; k0 += DIRECT_GROUP) {
+        double sum[DIRECT_GROUP] = {0.0};
+        for (int n = 0; n < count; n++) {
+            double x = input[nonzero[n]];
+            const double *t = table + (size_t)nonzero[n]*K + k0;
+            for (int k = 0; k < DIRECT_GROUP; k++) {
+                sum[k] += x * t[k];
+            }
+        }
+        memcpy(output + k0, sum, sizeof(sum));
+    }
+    for (int k = k0; k < K; k++) {
+        double sum = 0.0;
+        for (int n = 0; n < count; n++) {
+            sum += input[nonzero[n]] * table[(size_t)nonzero[n]*K + k];
+        }
+        output[k] = sum;
+    }
+}
+
+// Direct 2D DCT of a K = M*N block with the tables of direct_tables;
+// nonzero holds K scratch ints
+static void direct_dct(const double *input, double *output, int *nonzero, const double *basis,
+                       const double *scale, int K) {
+    direct_sums(input, output, basis, nonzero, K);
+    for (int k = 0; k < K; k++) {
+        output[k] = scale[k] * output[k];
+    }
+}
+
+// Direct 2D inverse DCT; weighted and nonzero hold K scratch values each
+static void direct_idct(const double *input, double *output, double *weighted, int *nonzero,
+                        const double *basis_t, const double *weight, int M, int N) {
+    int K = M*N;
+    for (int k = 0; k < K; k++) {
+        weighted[k] = weight[k] * input[k];
+    }
+    direct_sums(weighted, output, basis_t, nonzero, K);
+    for (int k = 0; k < K; k++) {
+        output[k] = (2.0 / sqrt(M*N)) * output[k];
+    }
+}
+
+// Direct transforms of one MxN block. The results match the original
+// O(N^4) loops exactly. 8x8 blocks go through the tables of direct_tables,
+// kept on the stack; other sizes keep the original table-free loops, as
+// their tables grow with (MN)^2. The frame functions below use the faster
+// separable transform.
 EXPORT void dct2(double *input, double *output, int M, int N) {
-    // ... (rest of the function remains the same)
-     for (int u = 0; u < M; u++) {
+    if (M == 8 && N == 8) {
+        double basis[64*64], basis_t[64*64], scale[64], weight[64];
+        int nonzero[64];
+        direct_tables(basis, basis_t, scale, weight, 8, 8);
+        direct_dct(input, output, nonzero, basis, scale, 64);
+        return;
+    }
+    for (int u = 0; u < M; u++) {
         for (int v = 0; v < N; v++) {
             double sum = 0.0;
             for (int i = 0; i < M; i++) {
@@ -28,7 +143,13 @@ EXPORT void dct2(double *input, double *output, int M, int N) {
 }
 
 EXPORT void idct2(double *input, double *output, int M, int N) {
-    // ... (rest of the function remains the same)
+    if (M == 8 && N == 8) {
+        double basis[64*64], basis_t[64*64], scale[64], weight[64], weighted[64];
+        int nonzero[64];
+        direct_tables(basis, basis_t, scale, weight, 8, 8);
+        direct_idct(input, output, weighted, nonzero, basis_t, weight, 8, 8);
+        return;
+    }
     for (int i = 0; i < M; i++) {
         for (int j = 0; j < N; j++) {
             double sum = 0.0;
@@ -43,4 +164,282 @@ EXPORT void idct2(double *input, double *output, int M, int N) {
             output[i*N + j] = (2.0 / sqrt(M*N)) * sum;
         }
     }
-}
\ No newline at end of file
+}
+
+// 8-point DCT of one row or column: out[u] = sum_x T[u][x] * in[x*stride]
+static inline void dct8_1d(const double *in, int stride, double *out, const double *T) {
+    double x0 = in[0], x1 = in[stride], x2 = in[2*stride], x3 = in[3*stride];
+    double x4 = in[4*stride], x5 = in[5*stride], x6 = in[6*stride], x7 = in[7*stride];
+    // Even and odd parts: the basis is symmetric for even u, antisymmetric for odd u
+    double s0 = x0 + x7, s1 = x1 + x6, s2 = x2 + x5, s3 = x3 + x4;
+    double d0 = x0 - x7, d1 = x1 - x6, d2 = x2 - x5, d3 = x3 - x4;
+    for (int u = 0; u < 8; u += 2) {
+        const double *t = T + u*8;
+        out[u] = t[0]*s0 + t[1]*s1 + t[2]*s2 + t[3]*s3;
+    }
+    for (int u = 1; u < 8; u += 2) {
+        const double *t = T + u*8;
+        out[u] = t[0]*d0 + t[1]*d1 + t[2]*d2 + t[3]*d3;
+    }
+}
+
+// 8-point inverse DCT: out[x*stride] = sum_u T[u][x] * in[u]
+static inline void idct8_1d(const double *in, double *out, int stride, const double *T) {
+    for (int x = 0; x < 4; x++) {
+        double even = 0.0, odd = 0.0;
+        for (int u = 0; u < 8; u += 2) {
+            even += T[u*8 + x] * in[u];
+            odd += T[(u + 1)*8 + x] * in[u + 1];
+        }
+        out[x*stride] = even + odd;
+        out[(7 - x)*stride] = even - odd;
+    }
+}
+
+// 2D DCT of a row-major 8x8 block
+static void dct8(const double *block, double *coeffs, const double *T) {
+    double rows[64], column[8];
+    for (int i = 0; i < 8; i++) {
+        dct8_1d(block + i*8, 1, rows + i*8, T);
+    }
+    for (int v = 0; v < 8; v++) {
+        dct8_1d(rows + v, 8, column, T);
+        for (int u = 0; u < 8; u++) {
+            coeffs[u*8 + v] = column[u];
+        }
+    }
+}
+
+// 2D inverse DCT of 64 coefficients into a row-major 8x8 block
+static void idct8(const double *coeffs, double *block, const double *T) {
+    double columns[64], column[8];
+    for (int v = 0; v < 8; v++) {
+        for (int u = 0; u < 8; u++) {
+            column[u] = coeffs[u*8 + v];
+        }
+        idct8_1d(column, columns + v, 8, T);
+    }
+    for (int i = 0; i < 8; i++) {
+        idct8_1d(columns + i*8, block + i*8, 1, T);
+    }
+}
+
+// Forward DCT of the 8x8 block of a frame at (top, left) into 64 coefficients
+static void dct8_block(const unsigned char *frame, int width, int top, int left,
+                       double *coeffs, const double *T) {
+    double block[64];
+    for (int i = 0; i < 8; i++) {
+        const unsigned char *p = frame + (size_t)(top + i) * width + left;
+        for (int j = 0; j < 8; j++) {
+            block[i*8 + j] = p[j];
+        }
+    }
+    dct8(block, coeffs, T);
+}
+
+// Store a row-major 8x8 block of pixels into a frame at (top, left).
+// Pixels are rounded through float, clipped to 0..255 and truncated, like
+// np.clip(x.astype(np.float32), 0, 255).astype(np.uint8).
+static void store_block(const double *block, unsigned char *frame, int width, int top, int left) {
+    for (int i = 0; i < 8; i++) {
+        unsigned char *p = frame + (size_t)(top + i) * width + left;
+        for (int j = 0; j < 8; j++) {
+            float value = (float)block[i*8 + j];
+            p[j] = value <= 0.0f ? 0 : value >= 255.0f ? 255 : (unsigned char)value;
+        }
+    }
+}
+
+// Inverse DCT of 64 coefficients into the 8x8 block of a frame at (top, left)
+static void idct8_block(const double *coeffs, unsigned char *frame, int width, int top, int left,
+                        const double *T) {
+    double block[64];
+    idct8(coeffs, block, T);
+    store_block(block, frame, width, top, left);
+}
+
+// Inverse DCT of residual coefficients added onto the 8x8 block of a frame
+// at (top, left), rounded to nearest and clipped
+static void add_residual_block(const double *coeffs, unsigned char *frame, int width,
+                               int top, int left, const double *T) {
+    double block[64];
+    idct8(coeffs, block, T);
+    for (int i = 0; i < 8; i++) {
+        unsigned char *p = frame + (size_t)(top + i) * width + left;
+        for (int j = 0; j < 8; j++) {
+            double value = nearbyint(p[j] + block[i*8 + j]);
+            p[j] = value <= 0.0 ? 0 : value >= 255.0 ? 255 : (unsigned char)value;
+        }
+    }
+}
+
+// Sum of absolute differences between the 8x8 blocks of two frames at (top, left)
+static int block_sad(const unsigned char *a, const unsigned char *b, int width, int top, int left) {
+    int sad = 0;
+    for (int i = 0; i < 8; i++) {
+        size_t row = (size_t)(top + i) * width + left;
+        for (int j = 0; j < 8; j++) {
+            sad += abs((int)a[row + j] - (int)b[row + j]);
+        }
+    }
+    return sad;
+}
+
+// Transform every 8x8 block of a height x width uint8 frame (both multiples
+// of 8). coeffs receives the blocks as a (height/8, width/8, 8, 8) grid.
+EXPORT void dct8_frame(const unsigned char *frame, double *coeffs, int height, int width) {
+    double T[64];
+    dct_table(T, 8);
+    int cols = width / 8;
+    for (int r = 0; r < height / 8; r++) {
+        for (int c = 0; c < cols; c++) {
+            dct8_block(frame, width, r*8, c*8, coeffs + ((size_t)r*cols + c) * 64, T);
+        }
+    }
+}
+
+// Inverse of dct8_frame: rebuild a uint8 frame from a grid of coefficients
+EXPORT void idct8_frame(const double *coeffs, unsigned char *frame, int height, int width) {
+    double T[64];
+    dct_table(T, 8);
+    int cols = width / 8;
+    for (int r = 0; r < height / 8; r++) {
+        for (int c = 0; c < cols; c++) {
+            idct8_block(coeffs + ((size_t)r*cols + c) * 64, frame, width, r*8, c*8, T);
+        }
+    }
+}
+
+// Transform, quantize with a uniform step and inverse-transform every 8x8
+// block of a frame in one call, with the separable transform. Rounding is
+// half to even, like np.round.
+EXPORT void dct8_quantize_frame(const unsigned char *frame, unsigned char *output,
+                                int height, int width, double step) {
+    double T[64], coeffs[64];
+    dct_table(T, 8);
+    for (int top = 0; top < height; top += 8) {
+        for (int left = 0; left < width; left += 8) {
+            dct8_block(frame, width, top, left, coeffs, T);
+            for (int k = 0; k < 64; k++) {
+                coeffs[k] = nearbyint(coeffs[k] / step) * step;
+            }
+            idct8_block(coeffs, output, width, top, left, T);
+        }
+    }
+}
+
+// dct8_quantize_frame with the direct transforms instead. This reproduces
+// the output of the per-block dct2, np.round, idct2 pipeline it replaced
+// exactly, where the separable transform differs in the last bits and so
+// flips values sitting on a rounding or truncation boundary. It runs at
+// about a third of the speed.
+EXPORT void dct8_quantize_frame_exact(const unsigned char *frame, unsigned char *output,
+                                      int height, int width, double step) {
+    double basis[64*64], basis_t[64*64], scale[64], weight[64];
+    double block[64], coeffs[64], weighted[64];
+    int nonzero[64];
+    direct_tables(basis, basis_t, scale, weight, 8, 8);
+    for (int top = 0; top < height; top += 8) {
+        for (int left = 0; left < width; left += 8) {
+            for (int i = 0; i < 8; i++) {
+                const unsigned char *p = frame + (size_t)(top + i) * width + left;
+                for (int j = 0; j < 8; j++) {
+                    block[i*8 + j] = p[j];
+                }
+            }
+            direct_dct(block, coeffs, nonzero, basis, scale, 64);
+            for (int k = 0; k < 64; k++) {
+                coeffs[k] = nearbyint(coeffs[k] / step) * step;
+            }
+            direct_idct(coeffs, block, weighted, nonzero, basis_t, weight, 8, 8);
+            store_block(block, output, width, top, left);
+        }
+    }
+}
+
+// Code a frame against the previous reconstruction. reference holds that
+// reconstruction and is updated in place to the new one. Blocks whose mean
+// absolute difference from the reference is below threshold are skipped:
+// no DCT, and the reference block is kept. Other blocks are coded like
+// dct8_quantize_frame, or with residual set, only their difference from the
+// reference is transformed and quantized and the result (rounded to
+// nearest) is added back. levels (height*width doubles, may be NULL)
+// receives the quantized levels of each block in (height/8, width/8, 8, 8)
+// order, zero for skipped blocks; skipped (one byte per block, may be NULL)
+// receives 1 for skipped blocks. Returns the number of skipped blocks.
+EXPORT int dct8_delta_frame(const unsigned char *frame, unsigned char *reference,
+                            int height, int width, double step, double threshold,
+                            int residual, double *levels, unsigned char *skipped) {
+    double T[64], block[64], coeffs[64];
+    dct_table(T, 8);
+    int cols = width / 8, skip_count = 0;
+    for (int r = 0; r < height / 8; r++) {
+        for (int c = 0; c < cols; c++) {
+            int top = r*8, left = c*8;
+            size_t index = (size_t)r*cols + c;
+            int skip = block_sad(frame, reference, width, top, left) < threshold * 64;
+            if (skipped) {
+                skipped[index] = (unsigned char)skip;
+            }
+            if (skip) {
+                skip_count++;
+                if (levels) {
+                    memset(levels + index*64, 0, sizeof(double) * 64);
+                }
+                continue;
+            }
+            if (residual) {
+                for (int i = 0; i < 8; i++) {
+                    size_t row = (size_t)(top + i) * width + left;
+                    for (int j = 0; j < 8; j++) {
+                        block[i*8 + j] = (double)frame[row + j] - reference[row + j];
+                    }
+                }
+                dct8(block, coeffs, T);
+            } else {
+                dct8_block(frame, width, top, left, coeffs, T);
+            }
+            for (int k = 0; k < 64; k++) {
+                double level = nearbyint(coeffs[k] / step);
+                if (levels) {
+                    levels[index*64 + k] = level;
+                }
+                coeffs[k] = level * step;
+            }
+            if (residual) {
+                add_residual_block(coeffs, reference, width, top, left, T);
+            } else {
+                idct8_block(coeffs, reference, width, top, left, T);
+            }
+        }
+    }
+    return skip_count;
+}
+
+// Decoder side of dct8_delta_frame: rebuild the reconstruction in reference
+// from the quantized levels and skip flags of a frame, exactly as the
+// encoder did
+EXPORT void idct8_delta_frame(const double *levels, const unsigned char *skipped,
+                              unsigned char *reference, int height, int width,
+                              double step, int residual) {
+    double T[64], coeffs[64];
+    dct_table(T, 8);
+    int cols = width / 8;
+    for (int r = 0; r < height / 8; r++) {
+        for (int c = 0; c < cols; c++) {
+            int top = r*8, left = c*8;
+            size_t index = (size_t)r*cols + c;
+            if (skipped[index]) {
+                continue;
+            }
+            for (int k = 0; k < 64; k++) {
+                coeffs[k] = levels[index*64 + k] * step;
+            }
+            if (residual) {
+                add_residual_block(coeffs, reference, width, top, left, T);
+            } else {
+                idct8_block(coeffs, reference, width, top, left, T);
+            }
+        }
+    }
+}
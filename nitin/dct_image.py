@@ -1,8 +1,45 @@
 import numpy as np
 from PIL import Image
+import contextlib
+import io
 import os
 import math
+import warnings
+from functools import lru_cache
+from naveen import huffman
+from bhanu import RLE
+from instrumentation import as_profile
+from result_cache import content_key
 Image.MAX_IMAGE_PIXELS = None
+
+# Container layout: magic, version, image height, width and strip height
+# (4 bytes each), a color transform byte and a plane count; then per plane
+# its height, width, rows per strip and 64 uint16 quantization steps; then
+# the strips in order, each holding the entropy-coded coefficients of every
+# plane (see encode_plane). Strips let large images be written and read
+# piecewise.
+CONTAINER_MAGIC = b'DCTI'
+CONTAINER_VERSION = 3
+
+# Color transforms: planes are the image channels as they are, or Y, Cb and
+# Cr planes of an RGB image with the chroma planes possibly subsampled
+COLOR_NONE = 0
+COLOR_YCBCR = 1
+
+# Chroma subsampling factors (rows, columns) for each mode
+SUBSAMPLING = {'4:4:4': (1, 1), '4:2:2': (1, 2), '4:2:0': (2, 2)}
+
+# Default rows per strip for the tiled pipeline (a multiple of 16)
+STRIP_HEIGHT = 256
+
+def zigzag_order(N=8):
+    """Return the row-major indices of an NxN block in zigzag order."""
+    return np.array(sorted(range(N * N), key=lambda i: (
+        i // N + i % N,
+        i // N if (i // N + i % N) % 2 else i % N)))
+
+ZIGZAG = zigzag_order()
+INVERSE_ZIGZAG = np.argsort(ZIGZAG)
 def create_dct_matrix(N=8):
     """Create the DCT transformation matrix of size NxN."""
     dct_matrix = np.zeros((N, N))
@@ -21,10 +58,17 @@ def create_dct_matrix(N=8):
     
     return dct_matrix
 
+@lru_cache(maxsize=None)
+def cached_dct_matrix(N=8):
+    """Return the NxN DCT matrix, built once per size and read-only."""
+    dct_matrix = create_dct_matrix(N)
+    dct_matrix.setflags(write=False)
+    return dct_matrix
+
 def custom_dct2d(block):
     """Apply 2D DCT to a block."""
     N = block.shape[0]
-    dct_matrix = create_dct_matrix(N)
+    dct_matrix = cached_dct_matrix(N)
     
     # 2D DCT = D * block * D^T
     result = np.matmul(dct_matrix, block)
@@ -35,7 +79,7 @@ def custom_dct2d(block):
 def custom_idct2d(block):
     """Apply 2D inverse DCT to a block."""
     N = block.shape[0]
-    dct_matrix = create_dct_matrix(N)
+    dct_matrix = cached_dct_matrix(N)
     
     # 2D IDCT = D^T * block * D
     result = np.matmul(dct_matrix.T, block)
@@ -43,8 +87,11 @@ def custom_idct2d(block):
     
     return result
 
-def get_quantization_matrix(quality):
-    """Generate quantization matrix based on quality factor."""
+def get_quantization_matrix(quality, chroma=False):
+    """Generate quantization matrix based on quality factor.
+
+    chroma=True scales the JPEG chrominance table instead of the luminance one.
+    """
     # Standard JPEG quantization matrix
     base_matrix = np.array([
         [16, 11, 10, 16, 24, 40, 51, 61],
@@ -56,6 +103,17 @@ def get_quantization_matrix(quality):
         [49, 64, 78, 87, 103, 121, 120, 101],
         [72, 92, 95, 98, 112, 100, 103, 99]
     ])
+    if chroma:
+        base_matrix = np.array([
+            [17, 18, 24, 47, 99, 99, 99, 99],
+            [18, 21, 26, 66, 99, 99, 99, 99],
+            [24, 26, 56, 99, 99, 99, 99, 99],
+            [47, 66, 99, 99, 99, 99, 99, 99],
+            [99, 99, 99, 99, 99, 99, 99, 99],
+            [99, 99, 99, 99, 99, 99, 99, 99],
+            [99, 99, 99, 99, 99, 99, 99, 99],
+            [99, 99, 99, 99, 99, 99, 99, 99]
+        ])
     
     if quality < 50:
         scale = 5000 / quality
@@ -111,54 +169,697 @@ def merge_blocks(blocks, height, width, channels, block_size=8):
     
     return image
 
-def compress_image(input_path, output_path, max_dimension,quality=50):
-    """Compress color image using DCT."""
+def block_grid(channel, block_size=8):
+    """View a 2D channel as a (rows, cols, block_size, block_size) grid of blocks.
+
+    Edges are zero-padded to whole blocks (the only copy made); the grid is a
+    strided view of the padded channel, in the same row-major block order
+    as split_into_blocks.
+    """
+    height, width = channel.shape
+    pad_h = -height % block_size
+    pad_w = -width % block_size
+    if pad_h or pad_w:
+        channel = np.pad(channel, ((0, pad_h), (0, pad_w)))
+    rows = (height + pad_h) // block_size
+    cols = (width + pad_w) // block_size
+    return channel.reshape(rows, block_size, cols, block_size).swapaxes(1, 2)
+
+def merge_block_grid(grid, height, width):
+    """Inverse of block_grid: join a block grid and crop it to height x width."""
+    rows, cols, block_size, _ = grid.shape
+    return grid.swapaxes(1, 2).reshape(rows * block_size, cols * block_size)[:height, :width]
+
+def batch_dct2d(blocks):
+    """Apply 2D DCT to every block of a (..., N, N) array in one call."""
+    dct_matrix = cached_dct_matrix(blocks.shape[-1])
+    return np.matmul(np.matmul(dct_matrix, blocks), dct_matrix.T)
+
+def batch_idct2d(blocks):
+    """Apply 2D inverse DCT to every block of a (..., N, N) array in one call."""
+    dct_matrix = cached_dct_matrix(blocks.shape[-1])
+    return np.matmul(np.matmul(dct_matrix.T, blocks), dct_matrix)
+
+def scaled_idct2d(quantized, Q, size=8):
+    """Dequantize and inverse-transform blocks to size x size pixels each.
+
+    Only the size x size lowest frequencies are used, with a size-point
+    IDCT scaled by size/8 to keep the orthonormal gain; size 1 gives the
+    block means (DC / 8). size 8 is the full batch_idct2d.
+    """
+    if size == 8:
+        return batch_idct2d(quantized * Q)
+    return batch_idct2d(quantized[..., :size, :size] * Q[:size, :size]) * (size / 8)
+
+def scaled_size(length, scale):
+    """Return the length of an image side decoded at 1/scale."""
+    return -(-length // scale)
+
+def image_channels(image):
+    """Return the list of 2D channels of an image array."""
+    if image.ndim == 3:
+        return [image[:, :, c] for c in range(image.shape[2])]
+    return [image]
+
+def zigzag_blocks(blocks):
+    """Return a grid of blocks as a (blocks, 64) array in zigzag order."""
+    # take keeps the result row-major; fancy indexing would not, and every
+    # ravel of it would copy
+    return blocks.reshape(-1, 64).take(ZIGZAG, axis=1)
+
+def plane_streams(zigzag, Q=None):
+    """Return the run and value varint streams encode_plane Huffman-codes
+    for blocks from zigzag_blocks, quantized already or, given Q in zigzag
+    order, quantized here.
+
+    Quantizing here only divides the coefficients that do not round to
+    zero, which at the qualities worth searching are a small share.
+    """
+    if Q is None:
+        flat = np.clip(zigzag, -32768, 32767).astype(np.int16).ravel()
+        positions = np.flatnonzero(flat)
+        values = flat[positions].astype(np.int64)
+    else:
+        positions = np.flatnonzero(np.abs(zigzag) >= Q / 2)
+        values = np.round(zigzag.ravel()[positions] / Q[positions % 64])
+        nonzero = values != 0
+        positions = positions[nonzero]
+        values = np.clip(values[nonzero], -32768, 32767).astype(np.int64)
+    runs = np.diff(positions, prepend=-1) - 1
+    values = (values << 1) ^ (values >> 63)
+    return RLE.encode_varints(runs), RLE.encode_varints(values)
+
+def encode_plane(quantized):
+    """Entropy-code a grid of quantized blocks.
+
+    Coefficients are taken as int16 in zigzag order and flattened across
+    blocks. Each nonzero value is stored with the number of zeros before it;
+    trailing zeros are implied by the block count. Runs and zigzag-signed
+    values become two varint streams, each Huffman-coded as bytes.
+    """
+    runs_data, values_data = (huffman.huffman_compress_bytes(stream)
+                              for stream in plane_streams(zigzag_blocks(quantized)))
+    return (len(runs_data).to_bytes(8, 'big') + runs_data
+            + len(values_data).to_bytes(8, 'big') + values_data)
+
+def encoded_plane_size(zigzag, Q):
+    """Return the length of encode_plane's output for blocks from
+    zigzag_blocks quantized with Q (in zigzag order), from the stream
+    histograms without packing any codes."""
+    return sum(8 + huffman.huffman_compressed_size(stream) for stream in plane_streams(zigzag, Q))
+
+def decode_plane(f, rows, cols):
+    """Read one plane written by encode_plane back into a (rows, cols, 8, 8) grid."""
+    runs = RLE.decode_varints(huffman.huffman_decompress_bytes(f.read(int.from_bytes(f.read(8), 'big'))))
+    values = RLE.decode_varints(huffman.huffman_decompress_bytes(f.read(int.from_bytes(f.read(8), 'big'))))
+    values = values.astype(np.int64)
+    flat = np.zeros(rows * cols * 64, dtype=np.int16)
+    flat[np.cumsum(runs.astype(np.int64) + 1) - 1] = (values >> 1) ^ -(values & 1)
+    return flat.reshape(-1, 64)[:, INVERSE_ZIGZAG].reshape(rows, cols, 8, 8)
+
+def rgb_channels(pixels):
+    """Return the R, G and B channels of an array. Integer channels are
+    left as they are, as multiplying them by a float gives float64."""
+    if pixels.dtype.kind == 'f':
+        pixels = pixels.astype(np.float64, copy=False)
+    return (pixels[..., c] for c in range(3))
+
+def rgb_to_luma(pixels):
+    """Convert an RGB array to a float Y plane (JFIF definition)."""
+    r, g, b = rgb_channels(pixels)
+    # Summed in place, in the order of 0.299 r + 0.587 g + 0.114 b
+    y = 0.299 * r
+    y += 0.587 * g
+    y += 0.114 * b
+    return y
+
+def rgb_to_chroma(pixels):
+    """Convert an RGB array to float Cb and Cr planes (JFIF definition)."""
+    r, g, b = rgb_channels(pixels)
+    cb = -0.168736 * r
+    cb += 128
+    cb -= 0.331264 * g
+    cb += 0.5 * b
+    cr = 0.5 * r
+    cr += 128
+    cr -= 0.418688 * g
+    cr -= 0.081312 * b
+    return cb, cr
+
+def rgb_to_ycbcr(pixels):
+    """Convert an RGB array to float Y, Cb and Cr planes (JFIF definition)."""
+    return (rgb_to_luma(pixels), *rgb_to_chroma(pixels))
+
+def subsampled_ycbcr(pixels, factor_y, factor_x):
+    """Convert an RGB array to a float Y plane and Cb and Cr planes averaged
+    over factor_y x factor_x cells, replicating the edges.
+
+    Cb and Cr are linear in RGB, so they are converted from the RGB cell
+    means instead of from every pixel. The result is that of rgb_to_ycbcr
+    and subsample up to float rounding.
+    """
+    if factor_y == factor_x == 1:
+        return list(rgb_to_ycbcr(pixels))
+    return [rgb_to_luma(pixels), *rgb_to_chroma(cell_means(pixels, factor_y, factor_x))]
+
+def cell_means(pixels, factor_y, factor_x):
+    """Average factor_y x factor_x cells of each channel of an array,
+    replicating the edges. 8-bit pixels are summed exactly in 16 bits."""
+    height, width = pixels.shape[:2]
+    pad_h = -height % factor_y
+    pad_w = -width % factor_x
+    if pad_h or pad_w:
+        pixels = np.pad(pixels, ((0, pad_h), (0, pad_w), (0, 0)), mode='edge')
+    # Whole rows first, which are contiguous, then the columns of the sums
+    total = pixels[::factor_y].astype(np.uint16 if pixels.dtype == np.uint8 else np.float64)
+    for i in range(1, factor_y):
+        total += pixels[i::factor_y]
+    sums = total[:, ::factor_x]
+    for j in range(1, factor_x):
+        sums = sums + total[:, j::factor_x]
+    return sums / (factor_y * factor_x)
+
+def subsample(plane, factor_y, factor_x):
+    """Average factor_y x factor_x cells of a plane, replicating the edges."""
+    height, width = plane.shape
+    pad_h = -height % factor_y
+    pad_w = -width % factor_x
+    if pad_h or pad_w:
+        plane = np.pad(plane, ((0, pad_h), (0, pad_w)), mode='edge')
+    rows = plane.shape[0] // factor_y
+    cols = plane.shape[1] // factor_x
+    return plane.reshape(rows, factor_y, cols, factor_x).mean(axis=(1, 3))
+
+def upsample(plane, factor_y, factor_x, height, width):
+    """Repeat each sample of a subsampled plane and crop to height x width."""
+    return plane.repeat(factor_y, axis=0).repeat(factor_x, axis=1)[:height, :width]
+
+def write_container_header(f, height, width, strip_height, planes, color=COLOR_NONE):
+    """Write the container header; planes are (height, width, strip rows, Q) tuples."""
+    f.write(CONTAINER_MAGIC + bytes([CONTAINER_VERSION]))
+    f.write(height.to_bytes(4, 'big') + width.to_bytes(4, 'big')
+            + strip_height.to_bytes(4, 'big') + bytes([color, len(planes)]))
+    for plane_height, plane_width, strip_rows, Q in planes:
+        f.write(plane_height.to_bytes(4, 'big') + plane_width.to_bytes(4, 'big')
+                + strip_rows.to_bytes(4, 'big'))
+        f.write(np.asarray(Q, dtype='>u2').tobytes())
+
+def read_container_header(f):
+    """Read the header written by write_container_header."""
+    if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+        raise ValueError("Not a DCT image container")
+    version = f.read(1)[0]
+    if version != CONTAINER_VERSION:
+        raise ValueError(f"Unsupported DCT container version {version}")
+    height, width, strip_height = (int.from_bytes(f.read(4), 'big') for _ in range(3))
+    color, plane_count = f.read(2)
+    planes = []
+    for _ in range(plane_count):
+        plane_height, plane_width, strip_rows = (int.from_bytes(f.read(4), 'big') for _ in range(3))
+        Q = np.frombuffer(f.read(128), dtype='>u2').reshape(8, 8).astype(np.float64)
+        planes.append((plane_height, plane_width, strip_rows, Q))
+    return height, width, strip_height, color, planes
+
+def iter_strips(f, height, width, strip_height, color, planes, scale=1, profile=None):
+    """Yield the reconstructed pixels of each strip of a container in order.
+
+    Only one strip of coefficients and pixels is held at a time. scale 2, 4
+    or 8 decodes at that fraction of the size from the low frequencies of
+    each block (see scaled_idct2d); tops and strips are then in scaled rows.
+    profile, an instrumentation.Profile, times the entropy decoding,
+    inverse transform, block merge and color conversion of every strip.
+    """
+    if scale not in (1, 2, 4, 8):
+        raise ValueError("scale must be 1, 2, 4 or 8")
+    profile = as_profile(profile)
+    size = 8 // scale
+    out_width = scaled_size(width, scale)
+    for index in range(-(-height // strip_height)):
+        top = index * strip_height
+        rows = scaled_size(min(strip_height, height - top), scale)
+        channels = []
+        for plane_height, plane_width, strip_rows, Q in planes:
+            plane_rows = min(strip_rows, plane_height - index * strip_rows)
+            with profile.stage('entropy'):
+                quantized = decode_plane(f, -(-plane_rows // 8), -(-plane_width // 8))
+            with profile.stage('transform'):
+                blocks = scaled_idct2d(quantized, Q, size)
+            with profile.stage('merge'):
+                channel = merge_block_grid(blocks, scaled_size(plane_rows, scale),
+                                           scaled_size(plane_width, scale))
+                # Subsampled planes are scaled back up to the full strip
+                channels.append(upsample(channel, -(-height // plane_height),
+                                         -(-width // plane_width), rows, out_width))
+        with profile.stage('color'):
+            if color == COLOR_YCBCR:
+                strip = ycbcr_to_rgb(*channels)
+            else:
+                strip = np.stack(channels, axis=-1) if len(channels) > 1 else channels[0]
+            strip = np.clip(strip, 0, 255).astype(np.uint8)
+            profile.count(strip.nbytes)
+        profile.progress(min(top + strip_height, height), height)
+        yield top // scale, strip
+
+def read_image(f, scale=1, profile=None):
+    """Decode a whole container from a file object into an array.
+
+    See iter_strips for scale and profile.
+    """
+    height, width, strip_height, color, planes = read_container_header(f)
+    shape = (scaled_size(height, scale), scaled_size(width, scale))
+    if len(planes) > 1:
+        shape += (len(planes),)
+    image = np.empty(shape, dtype=np.uint8)
+    for top, strip in iter_strips(f, height, width, strip_height, color, planes, scale, profile):
+        image[top:top + len(strip)] = strip
+    return image
+
+def preview_image(input_path, scale=8):
+    """Return a reduced-size decode of a container, 1/scale of each side.
+
+    Entropy decoding is the same as for a full decode, but no full IDCT
+    is done: scale 8 uses only the DC of each block. input_path may also
+    be a binary file object or the compressed bytes.
+    """
+    with open_input(input_path) as f:
+        return read_image(f, scale)
+
+def check_strip_height(strip_height, subsampling):
+    """Check that strips split every plane on whole blocks."""
+    factor_y = SUBSAMPLING[subsampling][0] if subsampling else 1
+    if strip_height <= 0 or strip_height % (8 * factor_y):
+        raise ValueError(f"strip_height must be a positive multiple of {8 * factor_y}")
+
+def plane_layout(shape, quality, strip_height, subsampling=None):
+    """Return the color transform and the (height, width, strip rows, Q) of each plane.
+
+    With subsampling set to a SUBSAMPLING mode, RGB images are coded as Y,
+    Cb and Cr planes with the chroma planes reduced and quantized with the
+    chrominance table; other images are coded as they are.
+    """
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    Q = get_quantization_matrix(quality)
+    if subsampling and channels == 3:
+        factor_y, factor_x = SUBSAMPLING[subsampling]
+        chroma_Q = get_quantization_matrix(quality, chroma=True)
+        chroma = (-(-height // factor_y), -(-width // factor_x), strip_height // factor_y, chroma_Q)
+        return COLOR_YCBCR, [(height, width, strip_height, Q), chroma, chroma]
+    return COLOR_NONE, [(height, width, strip_height, Q)] * channels
+
+def split_planes(strip, color, subsampling=None):
+    """Split a strip of pixels into the planes coded for it."""
+    if color == COLOR_YCBCR:
+        factor_y, factor_x = SUBSAMPLING[subsampling]
+        return subsampled_ycbcr(strip, factor_y, factor_x)
+    return image_channels(strip)
+
+def write_strips(f, pixels, quality, strip_height, subsampling=None, profile=None, cache=None):
+    """Transform, quantize and entropy-code an image strip by strip.
+
+    pixels only needs to support row slicing, so a memory map is read
+    one strip at a time. See plane_layout for subsampling. profile, an
+    instrumentation.Profile, times each step of every strip. With cache, a
+    result_cache.ResultCache, strips whose pixels were coded before with
+    the same settings are copied from it, so an image edited in places
+    only has the strips around the edits coded again.
+    """
+    check_strip_height(strip_height, subsampling)
+    profile = as_profile(profile)
+    height, width = pixels.shape[:2]
+    color, planes = plane_layout(pixels.shape, quality, strip_height, subsampling)
+    write_container_header(f, height, width, strip_height, planes, color)
+    params = {'version': CONTAINER_VERSION, 'quality': quality, 'subsampling': subsampling}
+    for top in range(0, height, strip_height):
+        with profile.stage('read'):
+            strip = np.asarray(pixels[top:top + strip_height])
+            profile.count(strip.nbytes)
+        if cache is not None:
+            with profile.stage('cache', strip.nbytes):
+                key = content_key('dct_image', params, strip)
+                data = cache.get(key, strip.nbytes)
+            if data is not None:
+                with profile.stage('write', len(data)):
+                    f.write(data)
+                profile.progress(min(top + strip_height, height), height)
+                continue
+            coded = []
+        with profile.stage('color'):
+            channels = split_planes(strip, color, subsampling)
+        for plane, (_, _, _, Q) in zip(channels, planes):
+            with profile.stage('split'):
+                blocks = block_grid(plane)
+            with profile.stage('transform'):
+                quantized = np.round(batch_dct2d(blocks) / Q)
+            with profile.stage('entropy'):
+                data = encode_plane(quantized)
+            with profile.stage('write', len(data)):
+                f.write(data)
+            if cache is not None:
+                coded.append(data)
+        if cache is not None:
+            with profile.stage('cache'):
+                cache.put(key, b''.join(coded))
+        profile.progress(min(top + strip_height, height), height)
+
+def single_strip_height(height, subsampling=None):
+    """Return the strip height that holds a whole image in one strip."""
+    block_rows = 8 * (SUBSAMPLING[subsampling][0] if subsampling else 1)
+    return max(block_rows, -(-height // block_rows) * block_rows)
+
+def transform_image(image_array, subsampling=None):
+    """Return the unquantized DCT blocks of each plane of an image coded as one strip."""
+    strip_height = single_strip_height(image_array.shape[0], subsampling)
+    color, _ = plane_layout(image_array.shape, 50, strip_height, subsampling)
+    return [batch_dct2d(block_grid(plane))
+            for plane in split_planes(image_array, color, subsampling)]
+
+def encode_coefficients(shape, coefficients, quality, subsampling=None):
+    """Quantize blocks from transform_image and return the container bytes.
+
+    The result is the same as compress_image writes for the image at this
+    quality.
+    """
+    height, width = shape[:2]
+    strip_height = single_strip_height(height, subsampling)
+    color, planes = plane_layout(shape, quality, strip_height, subsampling)
+    f = io.BytesIO()
+    write_container_header(f, height, width, strip_height, planes, color)
+    for blocks, (_, _, _, Q) in zip(coefficients, planes):
+        f.write(encode_plane(np.round(blocks / Q)))
+    return f.getvalue()
+
+def encoded_size(shape, zigzag, quality, subsampling=None):
+    """Return the length of encode_coefficients' output from the
+    zigzag_blocks of each plane's transform_image blocks.
+
+    Only the symbol histograms and code lengths are computed; no codes are
+    packed.
+    """
+    height, width = shape[:2]
+    strip_height = single_strip_height(height, subsampling)
+    color, planes = plane_layout(shape, quality, strip_height, subsampling)
+    f = io.BytesIO()
+    write_container_header(f, height, width, strip_height, planes, color)
+    return f.tell() + sum(encoded_plane_size(blocks, Q.ravel()[ZIGZAG])
+                          for blocks, (_, _, _, Q) in zip(zigzag, planes))
+
+def subsampling_error(image_array, subsampling=None):
+    """Return the mean squared error chroma subsampling adds to Y, Cb and Cr.
+
+    It does not depend on the quality, so it is computed once per image.
+    """
+    color, _ = plane_layout(image_array.shape, 50, 8, subsampling)
+    if color != COLOR_YCBCR:
+        return None
+    factor_y, factor_x = SUBSAMPLING[subsampling]
+    height, width = image_array.shape[:2]
+    errors = [0.0]
+    for plane in rgb_to_ycbcr(image_array)[1:]:
+        reduced = upsample(subsample(plane, factor_y, factor_x), factor_y, factor_x, height, width)
+        errors.append(float(np.mean((plane - reduced) ** 2)))
+    return errors
+
+def quantization_error(blocks, Q, height, width):
+    """Return the mean squared pixel error of quantizing the block grid of a
+    height x width plane with Q.
+
+    The DCT is orthonormal, so the squared quantization error of a block's
+    coefficients equals that of its pixels (Parseval). Blocks on a padded
+    edge are taken back to pixels, so that the padding, which is cropped
+    away on decoding, is not counted.
+    """
+    # In place, as this runs over every coefficient for each probe of search_quality
+    error = np.divide(blocks, Q)
+    np.round(error, out=error)
+    error *= Q
+    np.subtract(blocks, error, out=error)
+    full_rows, full_cols = height // 8, width // 8
+    inner = error[:full_rows, :full_cols]
+    total = float(np.einsum('ijkl,ijkl->', inner, inner))
+    for edge, rows, cols in ((error[full_rows:], height - 8 * full_rows, width),
+                             (error[:full_rows, full_cols:], 8 * full_rows, width - 8 * full_cols)):
+        if edge.size:
+            total += float(np.sum(merge_block_grid(batch_idct2d(edge), rows, cols) ** 2))
+    return total / (height * width)
+
+def estimate_psnr(shape, coefficients, quality, subsampling=None, base_error=None):
+    """Estimate the PSNR of an image coded at a quality from its DCT blocks.
+
+    Each plane's error is its quantization_error. For YCbCr, base_error is
+    the subsampling_error of the image, and the plane errors are carried
+    to RGB through the column norms of the inverse color transform. Clipping
+    and rounding to 8 bits are ignored.
+    """
+    strip_height = single_strip_height(shape[0], subsampling)
+    color, planes = plane_layout(shape, quality, strip_height, subsampling)
+    errors = [quantization_error(blocks, Q, height, width)
+              for blocks, (height, width, _, Q) in zip(coefficients, planes)]
+    if color == COLOR_YCBCR:
+        # Repeating a subsampled sample keeps its mean error, and that error
+        # is orthogonal to what subsampling removed
+        errors = [e + b for e, b in zip(errors, base_error or (0.0, 0.0, 0.0))]
+        mse = (3 * errors[0] + (0.344136 ** 2 + 1.772 ** 2) * errors[1]
+               + (1.402 ** 2 + 0.714136 ** 2) * errors[2]) / 3
+    else:
+        mse = sum(errors) / len(errors)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def search_quality(image_array, target_size=None, target_psnr=None, subsampling=None):
+    """Binary-search the quality for a byte budget or a PSNR target.
+
+    The DCT runs once; each probe only quantizes the cached blocks and
+    computes the container size from the symbol histograms (for
+    target_size) or estimates the PSNR (for target_psnr), so only the
+    chosen quality is entropy-coded. Picks the highest quality whose
+    container fits in target_size bytes, or the lowest whose PSNR reaches
+    target_psnr; when no quality meets the target the nearest end (1 or
+    100) is used. Qualities are whole numbers, so a PSNR target is
+    overshot by up to one quality step, which below quality 50 (where
+    the quantizer scales with 1/quality) is worth a few tenths of a dB.
+    Returns (quality, container bytes).
+    """
+    if (target_size is None) == (target_psnr is None):
+        raise ValueError("Give exactly one of target_size and target_psnr")
+    shape = image_array.shape
+    coefficients = transform_image(image_array, subsampling)
+    base_error = subsampling_error(image_array, subsampling) if target_psnr is not None else None
+
+    # Both size and PSNR grow with quality
+    low, high = 1, 100
+    if target_size is not None:
+        zigzag = [zigzag_blocks(blocks) for blocks in coefficients]
+        while low < high:
+            mid = (low + high + 1) // 2
+            if encoded_size(shape, zigzag, mid, subsampling) <= target_size:
+                low = mid
+            else:
+                high = mid - 1
+    else:
+        while low < high:
+            mid = (low + high) // 2
+            if estimate_psnr(shape, coefficients, mid, subsampling, base_error) >= target_psnr:
+                high = mid
+            else:
+                low = mid + 1
+    return low, encode_coefficients(shape, coefficients, low, subsampling)
+
+def open_output(output):
+    """Open a path for writing, or use an already open binary file as it is."""
+    if hasattr(output, 'write'):
+        return contextlib.nullcontext(output)
+    return open(output, 'wb')
+
+def open_input(source):
+    """Open a path for reading, or wrap bytes; binary files are used as they are."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if hasattr(source, 'read'):
+        return contextlib.nullcontext(source)
+    return open(source, 'rb')
+
+def open_pixels(source):
+    """Open an image as an array that reads rows on demand where possible.
+
+    Arrays (including memory maps) are used as they are and .npy files are
+    memory-mapped. Uncompressed images that PIL stores as a single raw tile
+    in the image's own mode (PPM/PGM, uncompressed TIFF) are memory-mapped
+    too. Anything else, including compressed formats such as JPEG and PNG,
+    encoded bytes and binary file objects, is decoded in full first, so
+    only uncompressed and .npy inputs are read with bounded memory.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    is_path = isinstance(source, (str, os.PathLike))
+    if is_path and str(source).endswith('.npy'):
+        return np.load(source, mmap_mode='r')
+    img = Image.open(source)
+    if is_path and len(img.tile) == 1 and img.mode in ('L', 'RGB', 'RGBA'):
+        codec, extents, offset, args = img.tile[0]
+        if not isinstance(args, tuple):
+            args = (args,)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        bands = len(img.getbands())
+        width, height = img.size
+        if (codec == 'raw' and extents == (0, 0, width, height) and rawmode == img.mode
+                and stride in (0, width * bands) and orientation in (1, -1)):
+            shape = (height, width, bands) if bands > 1 else (height, width)
+            pixels = np.memmap(source, dtype=np.uint8, mode='r', offset=offset, shape=shape)
+            return pixels if orientation == 1 else pixels[::-1]
+    return np.asarray(img)
+
+def compress_image_tiled(source, output_path, quality=50, strip_height=STRIP_HEIGHT,
+                         subsampling=None, profile=None, cache=None):
+    """Compress an image of any size with memory bounded by the strip size.
+
+    source is a path, an array, encoded bytes or a binary file object; see
+    open_pixels for which inputs are read lazily (compressed images are
+    decoded in full, so the bound holds for the coding only). output_path may also be a
+    binary file object. The image is not resized. See write_strips for
+    profile and cache.
+    """
+    check_strip_height(strip_height, subsampling)
+    profile = as_profile(profile)
+    with profile.stage('load'):
+        pixels = open_pixels(source)
+    with open_output(output_path) as f:
+        write_strips(f, pixels, quality, strip_height, subsampling, profile, cache)
+
+def decompress_image_tiled(input_path, output_path, scale=1, profile=None):
+    """Decompress a container strip by strip into a memory-mapped .npy file.
+
+    See iter_strips for scale and profile. input_path may also be a binary
+    file object or the compressed bytes.
+    """
+    profile = as_profile(profile)
+    with open_input(input_path) as f:
+        height, width, strip_height, color, planes = read_container_header(f)
+        shape = (scaled_size(height, scale), scaled_size(width, scale))
+        if len(planes) > 1:
+            shape += (len(planes),)
+        out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8, shape=shape)
+        for top, strip in iter_strips(f, height, width, strip_height, color, planes, scale,
+                                      profile):
+            with profile.stage('write', strip.nbytes):
+                out[top:top + len(strip)] = strip
+        with profile.stage('write'):
+            out.flush()
+            del out
+
+def load_image(source, max_dimension=None):
+    """Read an image, shrinking it to fit max_dimension.
+
+    source is a path, a binary file object, encoded image bytes or an array
+    of pixels.
+    """
     # Read image (now in color)
-    img = Image.open(input_path)
+    if isinstance(source, np.ndarray):
+        if not max_dimension or max(source.shape[:2]) <= max_dimension:
+            return source
+        img = Image.fromarray(source)
+    else:
+        img = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview))
+                         else source)
         # Resize if image is too large
-    if max(img.size) > max_dimension:
+    if max_dimension and max(img.size) > max_dimension:
         ratio = max_dimension / max(img.size)
         new_size = tuple(int(dim * ratio) for dim in img.size)
         img = img.resize(new_size, Image.Resampling.LANCZOS)
-    image_array = np.array(img)
-    
-    # Split image into 8x8 blocks for each channel
-    blocks, height, width, channels = split_into_blocks(image_array)
-    
-    # Get quantization matrix
-    Q = get_quantization_matrix(quality)
-    
-    # Process each channel
-    compressed_blocks = [[] for _ in range(channels)]
-    for c in range(channels):
-        for block in blocks[c]:
-            # Apply DCT
-            dct_block = custom_dct2d(block)  #dct(dct(block.T, norm='ortho').T, norm='ortho')
-            # Quantize
-            quantized = np.round(dct_block / Q)
-            compressed_blocks[c].append(quantized)
-    
-    # Save compressed data
-    compressed_data = {
-        'blocks': compressed_blocks,
-        'height': height,
-        'width': width,
-        'channels': channels,
-        'quality': quality
-    }
-    np.save(output_path, compressed_data)
+    return np.array(img)
+
+def source_size(source):
+    """Return the size in bytes of an image source as given to load_image."""
+    if isinstance(source, np.ndarray):
+        return source.nbytes
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    if hasattr(source, 'read'):
+        return source.seek(0, os.SEEK_END)
+    return os.path.getsize(source)
+
+def compress_image_bytes(image, quality=50, subsampling=None, max_dimension=None, profile=None,
+                         cache=None):
+    """Compress an image in memory and return the container bytes.
+
+    image is anything load_image accepts. Nothing but cache touches the
+    filesystem, so calls are safe to run concurrently. See write_strips for
+    profile and cache.
+    """
+    profile = as_profile(profile)
+    with profile.stage('load'):
+        image_array = load_image(image, max_dimension)
+    f = io.BytesIO()
+    # Transform and quantize all 8x8 blocks of each plane at once and save
+    # them as a single strip
+    write_strips(f, image_array, quality, single_strip_height(image_array.shape[0], subsampling),
+                 subsampling, profile, cache)
+    return f.getvalue()
+
+def compress_image(input_path, output_path, max_dimension,quality=50, subsampling=None,
+                   profile=None, cache=None):
+    """Compress color image using DCT.
+
+    subsampling ('4:4:4', '4:2:2' or '4:2:0') codes RGB images as YCbCr with
+    reduced chroma planes; None keeps the RGB channels as they are.
+    input_path may also be anything load_image accepts and output_path a
+    binary file object. See write_strips for profile and cache.
+    """
+    profile = as_profile(profile)
+    data = compress_image_bytes(input_path, quality, subsampling, max_dimension, profile, cache)
+    with profile.stage('save', len(data)), open_output(output_path) as f:
+        f.write(data)
     
     # Calculate compression ratio
-    original_size = os.path.getsize(input_path)
-    compressed_size = os.path.getsize(output_path)
-    compression_ratio = original_size / compressed_size
+    compression_ratio = source_size(input_path) / len(data)
     
     return compression_ratio
 
-def decompress_image(input_path, output_path):
-    """Decompress color image from DCT coefficients."""
-    # Load compressed data
-    compressed_data = np.load(input_path, allow_pickle=True).item()
+def compress_image_to_target(input_path, output_path, max_dimension, target_size=None,
+                             target_psnr=None, subsampling=None):
+    """Compress an image at the quality meeting a byte budget or PSNR target.
+
+    See search_quality. Returns the chosen quality and the compression ratio.
+    Accepts the same inputs and outputs as compress_image.
+    """
+    image_array = load_image(input_path, max_dimension)
+    quality, data = search_quality(image_array, target_size, target_psnr, subsampling)
+    with open_output(output_path) as f:
+        f.write(data)
+    return quality, source_size(input_path) / len(data)
+
+def decompress_image_array(data, scale=1, profile=None, legacy=False):
+    """Decompress an image to an array of pixels.
+
+    data is a path, a binary file object or the compressed bytes. scale 2,
+    4 or 8 decodes a preview at that fraction of the size (see iter_strips).
+    Containers are profiled as in iter_strips. Files written before the
+    container are pickled, and unpickling can run arbitrary code, so they
+    are only read with legacy set, and only trusted ones should be.
+    """
+    if scale not in (1, 2, 4, 8):
+        raise ValueError("scale must be 1, 2, 4 or 8")
+    with open_input(data) as f:
+        start = f.tell()
+        is_container = f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+        f.seek(start)
+        if is_container:
+            return read_image(f, scale, profile)
+
+        # Files written before the container are pickled .npy dicts
+        try:
+            compressed_data = np.load(f, allow_pickle=legacy)
+        except ValueError as e:
+            raise ValueError("Not a DCT image container; files from before the container "
+                             "are pickled and only load with legacy=True") from e
+        if compressed_data.dtype != object:
+            raise ValueError("Not a DCT image container")
+        warnings.warn("Loading a pickled legacy DCT image, which can run arbitrary code; "
+                      "only do this for trusted files")
+        compressed_data = compressed_data.item()
     compressed_blocks = compressed_data['blocks']
     height = compressed_data['height']
     width = compressed_data['width']
@@ -168,40 +869,98 @@ def decompress_image(input_path, output_path):
     # Get quantization matrix
     Q = get_quantization_matrix(quality)
     
-    # Process each channel
-    decompressed_blocks = [[] for _ in range(channels)]
+    # Dequantize and inverse-transform all blocks of each channel at once
+    rows = -(-height // 8)
+    cols = -(-width // 8)
+    planes = []
     for c in range(channels):
-        for quantized in compressed_blocks[c]:
-            # Dequantize
-            dct_block = quantized * Q
-            # Apply inverse DCT
-            block =custom_idct2d(dct_block)    # idct(idct(dct_block.T, norm='ortho').T, norm='ortho')
-            decompressed_blocks[c].append(block)
-    
-    # Merge blocks back into image
-    reconstructed_image = merge_blocks(decompressed_blocks, height, width, channels)
+        quantized = np.asarray(compressed_blocks[c], dtype=np.float64).reshape(rows, cols, 8, 8)
+        planes.append(merge_block_grid(scaled_idct2d(quantized, Q, 8 // scale),
+                                       scaled_size(height, scale), scaled_size(width, scale)))
+    reconstructed_image = np.stack(planes, axis=-1) if channels > 1 else planes[0]
     
     # Clip values and convert to uint8
-    reconstructed_image = np.clip(reconstructed_image, 0, 255).astype(np.uint8)
+    return np.clip(reconstructed_image, 0, 255).astype(np.uint8)
+
+def decompress_image(input_path, output_path, scale=1, image_format=None, profile=None,
+                     legacy=False):
+    """Decompress color image from DCT coefficients.
+
+    input_path is anything decompress_image_array accepts. output_path may
+    be a binary file object, written as image_format (PNG by default).
+    scale 2, 4 or 8 writes a preview at that fraction of the size. profile
+    also times the final save. legacy reads pickled pre-container files
+    (see decompress_image_array).
+    """
+    profile = as_profile(profile)
+    with profile.part(0, 0.8):
+        reconstructed_image = decompress_image_array(input_path, scale, profile, legacy)
+    if image_format is None and hasattr(output_path, 'write'):
+        image_format = 'PNG'
     
     # Save reconstructed image
-    Image.fromarray(reconstructed_image).save(output_path)
-def dct_image_compreser(input_image,output_image):
+    with profile.stage('save', reconstructed_image.nbytes):
+        Image.fromarray(reconstructed_image).save(output_path, format=image_format)
+def dct_image_compreser(input_image,output_image, target_size=None, target_psnr=None, profile=None,
+                        cache=None):
     
-    compressed_file = "compressed_image.npy"
-    
-    # Compress image
+    # Compress image in memory
+    profile = as_profile(profile)
     max_dimension=6000
-    quality = 50  # Quality factor (1-100, higher means better quality but larger file)
-    compression_ratio = compress_image(input_image, compressed_file, max_dimension, quality)
-    # print(f"Compression ratio: {compression_ratio:.2f}:1")
+    if cache is not None:
+        # The decoded image is cached whole, keyed by the source bytes, the
+        # targets and the output format
+        with profile.stage('cache'):
+            if hasattr(output_image, 'write'):
+                image_format = 'PNG'
+            else:
+                extension = os.path.splitext(output_image)[1].lower()
+                image_format = Image.registered_extensions().get(extension)
+                if image_format is None:
+                    raise ValueError(f"unknown file extension: {extension}")
+            if isinstance(input_image, (str, os.PathLike)):
+                with open(input_image, 'rb') as f:
+                    input_image = f.read()
+            elif hasattr(input_image, 'read'):
+                input_image = input_image.read()
+            key = content_key('dct_image_compreser',
+                              {'version': CONTAINER_VERSION, 'max_dimension': max_dimension,
+                               'target_size': target_size, 'target_psnr': target_psnr,
+                               'format': image_format}, input_image)
+            data = cache.get(key, source_size(input_image))
+        if data is not None:
+            with profile.stage('save', len(data)), open_output(output_image) as f:
+                f.write(data)
+            return
+    if target_size is not None or target_psnr is not None:
+        # Pick the quality for the byte budget or PSNR target
+        with profile.stage('load'):
+            image_array = load_image(input_image, max_dimension)
+        with profile.stage('search'):
+            quality, compressed_data = search_quality(image_array, target_size, target_psnr,
+                                                      subsampling='4:2:0')
+        profile.progress(0.5)
+    else:
+        quality = 50  # Quality factor (1-100, higher means better quality but larger file)
+        with profile.part(0, 0.5):
+            compressed_data = compress_image_bytes(input_image, quality, subsampling='4:2:0',
+                                                   max_dimension=max_dimension, profile=profile)
+    # print(f"Compression ratio: {source_size(input_image) / len(compressed_data):.2f}:1")
     
     # Decompress image
-    decompress_image(compressed_file, output_image)
+    with profile.part(0.5, 1):
+        if cache is None:
+            decompress_image(compressed_data, output_image, profile=profile)
+        else:
+            decoded = io.BytesIO()
+            decompress_image(compressed_data, decoded, image_format=image_format, profile=profile)
+            with profile.stage('save'), open_output(output_image) as f:
+                f.write(decoded.getvalue())
+            cache.put(key, decoded.getvalue())
     # print("Compression and decompression completed successfully!")
 
 
 # def main():
 #    dct_image_compreser("14.jpg","rr.jpg")
 # if __name__ == "__main__":
-#     main()
\ No newline at end of file
+#     main()
@@ -1,12 +1,29 @@
 import cv2
 import numpy as np
 import multiprocessing as mp
-from functools import partial
+from multiprocessing import shared_memory
+import queue
+import threading
+import time
+import contextlib
 import ctypes
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
 from numpy.ctypeslib import ndpointer
+from bhanu import RLE
+from nitin import dct_image
+from prashant import lzw
+from instrumentation import as_profile
 
-# Load the C library (keep your existing C DCT implementation)
-lib = ctypes.CDLL('./dct_functions.so')
+# Load the C library, built next to this file by running make in the
+# repository root
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dct_functions.so')
+try:
+    lib = ctypes.CDLL(LIBRARY_PATH)
+except OSError as e:
+    raise OSError(f"cannot load {LIBRARY_PATH} ({e}); build it with make in the "
+                  "repository root") from e
 lib.dct2.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
                      ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
                      ctypes.c_int, ctypes.c_int]
@@ -17,6 +34,62 @@ lib.idct2.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
                       ctypes.c_int, ctypes.c_int]
 lib.idct2.restype = None
 
+# Whole-frame 8x8 block transforms: frames are C-contiguous uint8 arrays
+# with both sides a multiple of 8, coefficients a (rows, cols, 8, 8) grid
+lib.dct8_frame.argtypes = [ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                           ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
+                           ctypes.c_int, ctypes.c_int]
+lib.dct8_frame.restype = None
+
+lib.idct8_frame.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
+                            ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                            ctypes.c_int, ctypes.c_int]
+lib.idct8_frame.restype = None
+
+lib.dct8_quantize_frame.argtypes = [ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                    ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                    ctypes.c_int, ctypes.c_int, ctypes.c_double]
+lib.dct8_quantize_frame.restype = None
+
+lib.dct8_quantize_frame_exact.argtypes = lib.dct8_quantize_frame.argtypes
+lib.dct8_quantize_frame_exact.restype = None
+
+# levels and skipped are optional outputs, passed as addresses or None
+lib.dct8_delta_frame.argtypes = [ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                 ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                 ctypes.c_int, ctypes.c_int, ctypes.c_double, ctypes.c_double,
+                                 ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+lib.dct8_delta_frame.restype = ctypes.c_int
+
+lib.idct8_delta_frame.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
+                                  ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                  ndpointer(ctypes.c_uint8, flags="C_CONTIGUOUS"),
+                                  ctypes.c_int, ctypes.c_int, ctypes.c_double, ctypes.c_int]
+lib.idct8_delta_frame.restype = None
+
+# Native container: magic, version, frame height and width (4 bytes each),
+# fps and quantization step (big-endian float64), a flags byte, then one
+# payload per frame and a trailing index (frame count, then the offset,
+# size and type of every frame, then the index offset) for seeking.
+VIDEO_MAGIC = b'DCTV'
+VIDEO_VERSION = 1
+VIDEO_EXTENSION = '.dctv'
+FLAG_RESIDUAL = 0x01
+
+# Frame payloads start with their type. Intra frames hold the quantized
+# levels of every block (dct_image.encode_plane). Delta frames hold the
+# RLE-coded packed skip flags and the levels of the blocks that were not
+# skipped; they depend on the previous frame.
+FRAME_INTRA = 0
+FRAME_DELTA = 1
+
+# Delta coding restarts with an intra frame this often, so decoding can
+# start (and be split across processes) there
+KEYFRAME_INTERVAL = 64
+
+# Frames decoded per task by decompress_video, at least
+DECODE_SEGMENT = 16
+
 def dct2(block):
     M, N = block.shape
     input_array = block.astype(np.float64)
@@ -31,32 +104,249 @@ def idct2(block):
     lib.idct2(input_array, output_array, M, N)
     return output_array
 
-def compress_channel(channel, quality):
-    height, width = channel.shape
+def pad_frame(frame):
+    """Edge-pad a 2D frame to whole 8x8 blocks as a contiguous uint8 array."""
+    height, width = frame.shape
     # Pad the image if dimensions are not multiples of 8
     pad_h = (8 - height % 8) % 8
     pad_w = (8 - width % 8) % 8
     if pad_h > 0 or pad_w > 0:
-        channel = np.pad(channel, ((0, pad_h), (0, pad_w)), mode='edge')
-    
-    # Reshape the array to work with 8x8 blocks
-    blocks = channel.reshape(height//8, 8, width//8, 8).transpose(0, 2, 1, 3).reshape(-1, 8, 8)
-    compressed_blocks = np.zeros_like(blocks, dtype=np.float32)
-    
-    # Process each block
-    for i, block in enumerate(blocks):
-        dct_block = dct2(block.astype(np.float64))
-        dct_block = np.round(dct_block / quality) * quality
-        compressed_blocks[i] = idct2(dct_block)
-    
-    # Reshape back to original dimensions
-    compressed = compressed_blocks.reshape(height//8, width//8, 8, 8).transpose(0, 2, 1, 3).reshape(height+pad_h, width+pad_w)
+        frame = np.pad(frame, ((0, pad_h), (0, pad_w)), mode='edge')
+    return np.ascontiguousarray(frame, dtype=np.uint8)
+
+def dct_frame(frame):
+    """Transform every 8x8 block of a 2D frame in one C call.
+
+    Returns a (rows, cols, 8, 8) grid of coefficients of the edge-padded frame.
+    """
+    frame = pad_frame(frame)
+    height, width = frame.shape
+    coeffs = np.empty((height // 8, width // 8, 8, 8), dtype=np.float64)
+    lib.dct8_frame(frame, coeffs, height, width)
+    return coeffs
+
+def idct_frame(coeffs, height, width):
+    """Inverse of dct_frame: rebuild a height x width uint8 frame."""
+    rows, cols = coeffs.shape[:2]
+    frame = np.empty((rows * 8, cols * 8), dtype=np.uint8)
+    lib.idct8_frame(np.ascontiguousarray(coeffs, dtype=np.float64), frame, rows * 8, cols * 8)
+    return np.ascontiguousarray(frame[:height, :width])
+
+def compress_channel(channel, quality, out=None, exact=False):
+    """DCT, quantize and inverse-DCT every 8x8 block of a channel in one C call.
+
+    The result is written to out when given, otherwise to a new array.
+    With exact set the slower direct transform is used, whose output
+    matches the per-block dct2/idct2 pipeline bit for bit.
+    """
+    height, width = channel.shape
+    padded = pad_frame(channel)
+    if out is not None and out.shape == padded.shape and out.flags['C_CONTIGUOUS']:
+        compressed = out
+    else:
+        compressed = np.empty_like(padded)
+    quantize = lib.dct8_quantize_frame_exact if exact else lib.dct8_quantize_frame
+    quantize(padded, compressed, padded.shape[0], padded.shape[1], float(quality))
+    if out is not None:
+        if compressed is not out:
+            out[...] = compressed[:height, :width]
+        return out
     
     # Remove padding if added
-    if pad_h > 0 or pad_w > 0:
-        compressed = compressed[:height, :width]
+    if compressed.shape != (height, width):
+        compressed = np.ascontiguousarray(compressed[:height, :width])
     
-    return np.clip(compressed, 0, 255).astype(np.uint8)
+    return compressed
+
+def compress_channel_delta(channel, reference, quality, threshold, residual=False,
+                           levels=None, skipped=None):
+    """Code a channel against the previous reconstructed frame.
+
+    reference is the edge-padded reconstruction of the previous frame and
+    is updated in place; pass None for the first frame, which is coded in
+    full. Blocks whose mean absolute difference from the reference is below
+    threshold are skipped (no DCT), the rest are coded as in
+    compress_channel or, with residual, as their difference from the
+    reference. levels (a float64 block grid) and skipped (a uint8 array
+    with one flag per block) receive the quantized levels and skip flags
+    when given. Returns the new reference and the number of skipped blocks.
+    """
+    padded = pad_frame(channel)
+    if reference is None:
+        reference = np.empty_like(padded)
+        threshold = -1
+        residual = False
+    count = lib.dct8_delta_frame(padded, reference, padded.shape[0], padded.shape[1],
+                                 float(quality), float(threshold), int(residual),
+                                 None if levels is None else levels.ctypes.data,
+                                 None if skipped is None else skipped.ctypes.data)
+    return reference, count
+
+def encode_frame_payload(levels, skipped=None):
+    """Entropy-code the quantized levels of a frame (and its skip flags for delta frames)."""
+    if skipped is None:
+        return bytes([FRAME_INTRA]) + dct_image.encode_plane(levels)
+    flags = RLE.rle_compress_bytes(np.packbits(skipped).tobytes())
+    payload = bytes([FRAME_DELTA]) + len(flags).to_bytes(8, 'big') + flags
+    coded = levels[skipped == 0]
+    # Wholly static frames carry no levels at all
+    return payload + dct_image.encode_plane(coded) if len(coded) else payload
+
+def decode_frame_payload(payload, rows, cols):
+    """Inverse of encode_frame_payload: return the level grid and skip flags (None if intra)."""
+    f = io.BytesIO(payload)
+    if f.read(1)[0] == FRAME_INTRA:
+        return np.ascontiguousarray(dct_image.decode_plane(f, rows, cols), dtype=np.float64), None
+    flags = RLE.rle_decompress_bytes(f.read(int.from_bytes(f.read(8), 'big')))
+    skipped = np.unpackbits(np.frombuffer(flags, dtype=np.uint8), count=rows * cols)
+    skipped = np.ascontiguousarray(skipped.reshape(rows, cols))
+    levels = np.zeros((rows, cols, 8, 8), dtype=np.float64)
+    coded = skipped == 0
+    count = int(coded.sum())
+    if count:
+        levels[coded] = dct_image.decode_plane(f, count, 1).reshape(count, 8, 8)
+    return levels, skipped
+
+class VideoContainerWriter:
+    """Write frame payloads to a native container, like cv2.VideoWriter."""
+
+    def __init__(self, path, height, width, fps, quality, residual=False):
+        self.file = open(path, 'wb')
+        self.entries = []
+        self.file.write(VIDEO_MAGIC + bytes([VIDEO_VERSION]))
+        self.file.write(height.to_bytes(4, 'big') + width.to_bytes(4, 'big'))
+        self.file.write(np.array([fps, quality], dtype='>f8').tobytes())
+        self.file.write(bytes([FLAG_RESIDUAL if residual else 0]))
+
+    def write(self, payload):
+        self.entries.append((self.file.tell(), len(payload), payload[0]))
+        self.file.write(payload)
+
+    def release(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(len(self.entries).to_bytes(4, 'big'))
+        for offset, size, frame_type in self.entries:
+            self.file.write(offset.to_bytes(8, 'big') + size.to_bytes(8, 'big') + bytes([frame_type]))
+        self.file.write(index_offset.to_bytes(8, 'big'))
+        self.file.close()
+
+def read_video_header(f):
+    """Read a native container's header and index.
+
+    Returns (height, width, fps, quality, residual, entries) with entries
+    the (offset, size, type) of every frame.
+    """
+    f.seek(0)
+    if f.read(len(VIDEO_MAGIC)) != VIDEO_MAGIC:
+        raise ValueError("Not a DCT video container")
+    if f.read(1)[0] != VIDEO_VERSION:
+        raise ValueError("Unsupported DCT video container version")
+    height, width = (int.from_bytes(f.read(4), 'big') for _ in range(2))
+    fps, quality = np.frombuffer(f.read(16), dtype='>f8').tolist()
+    residual = bool(f.read(1)[0] & FLAG_RESIDUAL)
+    f.seek(-8, 2)
+    f.seek(int.from_bytes(f.read(8), 'big'))
+    count = int.from_bytes(f.read(4), 'big')
+    index = f.read(17 * count)
+    entries = [(int.from_bytes(index[i:i + 8], 'big'), int.from_bytes(index[i + 8:i + 16], 'big'),
+                index[i + 16]) for i in range(0, len(index), 17)]
+    return height, width, fps, quality, residual, entries
+
+def iter_video_frames(input_path, start=0, stop=None):
+    """Yield the decoded frames start..stop-1 of a native container in order.
+
+    Decoding starts at the last intra frame at or before start.
+    """
+    with open(input_path, 'rb') as f:
+        height, width, fps, quality, residual, entries = read_video_header(f)
+        stop = len(entries) if stop is None else min(stop, len(entries))
+        first = start
+        while first > 0 and entries[first][2] != FRAME_INTRA:
+            first -= 1
+        rows, cols = -(-height // 8), -(-width // 8)
+        reference = np.empty((rows * 8, cols * 8), dtype=np.uint8)
+        for index in range(first, stop):
+            offset, size, _ = entries[index]
+            f.seek(offset)
+            levels, skipped = decode_frame_payload(f.read(size), rows, cols)
+            if skipped is None:
+                lib.idct8_frame(levels * quality, reference, rows * 8, cols * 8)
+            else:
+                lib.idct8_delta_frame(levels, skipped, reference, rows * 8, cols * 8,
+                                      quality, int(residual))
+            if index >= start:
+                yield reference[:height, :width].copy()
+
+def _decode_segment(input_path, start, stop):
+    return np.array(list(iter_video_frames(input_path, start, stop)))
+
+def video_segments(entries, start, stop, size=DECODE_SEGMENT):
+    """Split frames start..stop-1 into ranges that each begin at an intra frame.
+
+    The first range may begin before its intra frame is reached (it is
+    decoded from there). Ranges are at least size frames where the intra
+    frames allow. An empty range gives no ranges.
+    """
+    if stop <= start:
+        return []
+    cuts = [start] + [i for i in range(start + 1, stop) if entries[i][2] == FRAME_INTRA] + [stop]
+    segments = []
+    for begin, end in zip(cuts, cuts[1:]):
+        if segments and segments[-1][1] - segments[-1][0] < size:
+            segments[-1] = (segments[-1][0], end)
+        else:
+            segments.append((begin, end))
+    return segments
+
+def decompress_video(input_path, output_path, start=0, stop=None, workers=None, profile=None):
+    """Decode frames start..stop-1 of a native container in parallel.
+
+    The range is split at intra frames and the pieces are decoded across a
+    process pool, then written in order to output_path: a .npy file (the
+    exact decoded frames, memory-mapped) or a grayscale mp4v video.
+    Returns the number of frames written. profile, an
+    instrumentation.Profile, records the time spent waiting for decoded
+    segments and writing them.
+    """
+    profile = as_profile(profile)
+    with open(input_path, 'rb') as f:
+        height, width, fps, quality, residual, entries = read_video_header(f)
+    stop = len(entries) if stop is None else min(stop, len(entries))
+    start = max(0, min(start, stop))
+    segments = video_segments(entries, start, stop)
+    if output_path.endswith('.npy'):
+        out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8,
+                                        shape=(stop - start, height, width))
+    else:
+        out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                              (width, height), isColor=False)
+    workers = workers or mp.cpu_count()
+    written = 0
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            tasks = [(input_path, begin, end) for begin, end in segments]
+            decoded = lzw.map_ordered(pool, _decode_segment, tasks, 2 * workers)
+            while True:
+                with profile.stage('decode'):
+                    frames = next(decoded, None)
+                if frames is None:
+                    break
+                with profile.stage('write', frames.nbytes):
+                    if isinstance(out, np.ndarray):
+                        out[written:written + len(frames)] = frames
+                    else:
+                        for frame in frames:
+                            out.write(frame)
+                written += len(frames)
+                profile.progress(written, stop - start)
+    finally:
+        if isinstance(out, np.ndarray):
+            out.flush()
+        else:
+            out.release()
+    return written
 
 def compress_frame(frame, quality):
     return compress_channel(frame, quality)
@@ -64,48 +354,189 @@ def compress_frame(frame, quality):
 def process_batch(frames, quality):
     return [compress_frame(frame, quality) for frame in frames]
 
-def compress_video(input_path, output_path, quality=5, batch_size=64):
+# Frame ring shared with the pool workers: ring[0, slot] holds an input
+# frame and ring[1, slot] its compressed output
+_ring_memory = None
+_ring = None
+
+def _attach_ring(name, shape):
+    """Pool initializer: map the shared frame ring into this process."""
+    global _ring_memory, _ring
+    _ring_memory = shared_memory.SharedMemory(name=name)
+    _ring = np.ndarray(shape, dtype=np.uint8, buffer=_ring_memory.buf)
+
+def _compress_slot(slot, quality):
+    compress_channel(_ring[0, slot], quality, out=_ring[1, slot])
+    return slot
+
+def _encode_slot(slot, quality):
+    return slot, encode_frame_payload(np.round(dct_frame(_ring[0, slot]) / quality))
+
+def compress_video(input_path, output_path, quality=5, ring_size=None, workers=None,
+                   skip_threshold=None, residual=False, native=None,
+                   keyframe_interval=KEYFRAME_INTERVAL, profile=None):
+    """Compress a video to grayscale DCT-quantized frames.
+
+    A reader thread decodes frames straight into free slots of a ring in
+    shared memory and hands each slot to the pool, which compresses it in
+    place. A writer thread waits for the slots in frame order and writes
+    them out, then frees them. Frames are never pickled, and reading,
+    compressing and writing overlap. ring_size (default twice the worker
+    count) bounds the frames in flight.
+
+    With skip_threshold set, each frame is coded against the previous
+    reconstructed frame instead (see compress_channel_delta). Frames then
+    depend on each other, so the writer thread codes them in order while
+    the reader keeps decoding ahead; the pool is not used. Every
+    keyframe_interval frames (0 for never) a frame is coded in full.
+
+    With native set (the default for a .dctv output_path) the quantized
+    levels are entropy-coded into a native container (see
+    VideoContainerWriter) instead of reconstructing the frames and
+    re-encoding them with mp4v; decompress_video reads it back.
+
+    profile, an instrumentation.Profile, records the reader thread's
+    decoding and grayscale conversion, the writer thread's coding and
+    writing, and how long the writer waited on the pool. Progress is
+    measured against the frame count the input reports.
+    """
+    profile = as_profile(profile)
     cap = cv2.VideoCapture(input_path)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = int(cap.get(cv2.CAP_PROP_FPS))
+    frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height), isColor=False)
+    if native is None:
+        native = output_path.endswith(VIDEO_EXTENSION)
+    delta = skip_threshold is not None
+    if native:
+        out = VideoContainerWriter(output_path, height, width, cap.get(cv2.CAP_PROP_FPS), quality,
+                                   delta and residual)
+    else:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height), isColor=False)
     
+    workers = workers or mp.cpu_count()
+    ring_size = ring_size or 2 * workers
+    shape = (2, ring_size, height, width)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))))
+    ring = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+    free_slots = queue.Queue()
+    for slot in range(ring_size):
+        free_slots.put(slot)
+    pending = queue.Queue()
+    stop = threading.Event()
+    errors = []
     frame_count = 0
-    frames_batch = []
-    
-    with mp.Pool(mp.cpu_count()) as pool:
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Convert frame to grayscale
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            frames_batch.append(gray_frame)
-            
-            if len(frames_batch) == batch_size:
-                # Process batch of frames in parallel
-                compressed_frames = pool.map(partial(compress_frame, quality=quality), frames_batch)
-                for compressed in compressed_frames:
-                    out.write(compressed)
-                frame_count += len(frames_batch)
-                print(f"Processed {frame_count} frames")
-                frames_batch = []
-        
-        # Process remaining frames
-        if frames_batch:
-            compressed_frames = pool.map(partial(compress_frame, quality=quality), frames_batch)
-            for compressed in compressed_frames:
-                out.write(compressed)
-            frame_count += len(frames_batch)
-    
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    skipped_blocks = 0
+    total_blocks = 0
+
+    def read_frames(pool):
+        try:
+            while cap.isOpened() and not stop.is_set():
+                started = time.perf_counter()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                profile.add('read', time.perf_counter() - started, frame.nbytes)
+                slot = None
+                while slot is None and not stop.is_set():
+                    try:
+                        slot = free_slots.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                if slot is None:
+                    break
+                # Convert frame to grayscale
+                started = time.perf_counter()
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=ring[0, slot])
+                profile.add('gray', time.perf_counter() - started)
+                if delta:
+                    pending.put(slot)
+                else:
+                    task = _encode_slot if native else _compress_slot
+                    pending.put(pool.apply_async(task, (slot, quality)))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            pending.put(None)
+
+    def write_frames():
+        nonlocal frame_count, skipped_blocks, total_blocks
+        reference = None
+        if native and delta:
+            levels = np.empty((-(-height // 8), -(-width // 8), 8, 8), dtype=np.float64)
+            flags = np.empty(levels.shape[:2], dtype=np.uint8)
+        else:
+            levels = flags = None
+        try:
+            while True:
+                result = pending.get()
+                if result is None:
+                    break
+                if delta:
+                    slot = result
+                    keyframe = reference is None or (
+                        keyframe_interval and frame_count % keyframe_interval == 0)
+                    with profile.stage('transform', height * width):
+                        reference, skipped = compress_channel_delta(
+                            ring[0, slot], None if keyframe else reference, quality,
+                            skip_threshold, residual, levels, flags)
+                    skipped_blocks += skipped
+                    total_blocks += reference.size // 64
+                    if native:
+                        with profile.stage('entropy'):
+                            payload = encode_frame_payload(levels, None if keyframe else flags)
+                        with profile.stage('write', len(payload)):
+                            out.write(payload)
+                    else:
+                        with profile.stage('write', height * width):
+                            ring[1, slot] = reference[:height, :width]
+                            out.write(ring[1, slot])
+                elif native:
+                    with profile.stage('pool'):
+                        slot, payload = result.get()
+                    with profile.stage('write', len(payload)):
+                        out.write(payload)
+                else:
+                    with profile.stage('pool'):
+                        slot = result.get()
+                    with profile.stage('write', height * width):
+                        out.write(ring[1, slot])
+                free_slots.put(slot)
+                frame_count += 1
+                profile.progress(frame_count, frame_total)
+                if frame_count % 64 == 0:
+                    print(f"Processed {frame_count} frames")
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    try:
+        if delta:
+            pool_context = contextlib.nullcontext()
+        else:
+            pool_context = mp.Pool(workers, initializer=_attach_ring, initargs=(memory.name, shape))
+        with pool_context as pool:
+            reader = threading.Thread(target=read_frames, args=(pool,))
+            writer = threading.Thread(target=write_frames)
+            reader.start()
+            writer.start()
+            reader.join()
+            writer.join()
+    finally:
+        del ring
+        memory.close()
+        memory.unlink()
+        cap.release()
+        out.release()
+    if errors:
+        raise errors[0]
     print(f"Compression complete. Processed {frame_count} frames.")
+    if total_blocks:
+        print(f"Skipped {skipped_blocks} of {total_blocks} blocks ({100 * skipped_blocks / total_blocks:.1f}%).")
 
 # # Usage example
 # if __name__ == '__main__':
@@ -1,8 +1,39 @@
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
 from os.path import getsize
 
+import numpy as np
+
+from instrumentation import as_profile
+from result_cache import content_chunks, content_key
+
 PARSE_BYTES = 6
 MAX_CHARACTERS = 65536
 
+# Variable-width format: magic, max code width byte, then MSB-first packed
+# codes. Widths start at 17 bits and grow as the table fills; once it is
+# full a CLEAR_CODE is written and both sides start over.
+LZW_MAGIC = b'LZWV'
+CLEAR_CODE = MAX_CHARACTERS
+FIRST_CODE = MAX_CHARACTERS + 1
+MIN_CODE_BITS = FIRST_CODE.bit_length()
+MAX_CODE_BITS = 20
+READ_CHUNK = 1 << 20
+
+# Chunked format: magic, max code width byte, then one variable-width
+# stream per chunk, each with its own dictionary. An index of (offset,
+# packed bytes, characters) per chunk follows the streams, and the last
+# 8 bytes give the offset of that index.
+LZW_CHUNKED_MAGIC = b'LZWC'
+CHUNK_CHARACTERS = 1 << 22
+
+# Average characters per chunk when compressing with a cache. Every chunk
+# starts a new dictionary, so smaller chunks would be reused at a finer
+# grain but cost ratio (see lzw_chunk_ratio_loss).
+CACHE_CHUNK_CHARACTERS = CHUNK_CHARACTERS
+
 
 def init_lzw_compression_table():
     compression_table = {}
@@ -18,7 +49,7 @@ def init_lzw_decompression_table():
     return decompression_table
 
 
-def lzw_compress(input_file_path, output_file_path):
+def lzw_compress_fixed_width(input_file_path, output_file_path):
     file = open(input_file_path, "r", encoding="utf-8")
     compressed_file = open(output_file_path, "wb")
     if getsize(input_file_path) == 0:
@@ -48,7 +79,7 @@ def lzw_compress(input_file_path, output_file_path):
     file.close()
 
 
-def lzw_decompress(input_file_path, output_file_path):
+def lzw_decompress_fixed_width(input_file_path, output_file_path):
     file = open(input_file_path, "rb")
     decompressed_file = open(output_file_path, "w", encoding="utf-8")
     if getsize(input_file_path) == 0:
@@ -78,3 +109,352 @@ def lzw_decompress(input_file_path, output_file_path):
         old = num
     decompressed_file.close()
     file.close()
+
+
+def check_max_bits(max_bits):
+    if not MIN_CODE_BITS <= max_bits <= 32:
+        raise ValueError(f"max_bits must be between {MIN_CODE_BITS} and 32")
+
+
+# Pack codes that all share one width into bytes. Bits left over from the
+# previous call come in as (carry, carry_bits); the bits that do not fill a
+# byte are returned the same way.
+def pack_codes(codes, width, carry, carry_bits):
+    bits = np.unpackbits(np.array(codes, dtype='>u4').view(np.uint8)).reshape(-1, 32)[:, 32 - width:]
+    if carry_bits:
+        head = np.unpackbits(np.array([carry << (32 - carry_bits)], dtype='>u4').view(np.uint8))[:carry_bits]
+        bits = np.concatenate((head, bits.ravel()))
+    else:
+        bits = bits.ravel()
+    whole = len(bits) - len(bits) % 8
+    tail = bits[whole:]
+    carry = int(''.join(map(str, tail)), 2) if len(tail) else 0
+    return np.packbits(bits[:whole]).tobytes(), carry, len(tail)
+
+
+# Encoder for the variable-width format. The single characters are the
+# implicit codes 0..MAX_CHARACTERS-1, and longer strings are keyed on
+# (prefix code << 16) | next character, so no table is built up front and
+# no strings are concatenated. Text arrives in chunks; emitted codes are
+# collected while their width stays the same and packed in bulk. Each
+# character costs one setdefault, which both looks the key up and, on a
+# miss, adds it; on text with short phrases most characters miss.
+def lzw_encode_chunks(chunks, write, max_bits=MAX_CODE_BITS):
+    check_max_bits(max_bits)
+    limit = 1 << max_bits
+    table = {}
+    insert = table.setdefault
+    code = FIRST_CODE
+    # Every code in the table fits in the width of the newest one, until
+    # code reaches check: the next width step or the table limit
+    width = (code - 1).bit_length()
+    check = min((1 << width) + 1, limit)
+    pending = []
+    emit = pending.append
+    carry = 0
+    carry_bits = 0
+    prefix = -1
+    for chunk in chunks:
+        chunk = chunk.replace('\ufeff', '')
+        if not chunk:
+            continue
+        if max(chunk) > '\uffff':
+            raise ValueError("LZW input is limited to characters below U+10000")
+        symbols = map(ord, chunk)
+        if prefix < 0:
+            prefix = next(symbols)
+        for symbol in symbols:
+            found = insert((prefix << 16) | symbol, code)
+            if found != code:
+                prefix = found
+                continue
+            emit(prefix)
+            code += 1
+            prefix = symbol
+            if code == check:
+                packed, carry, carry_bits = pack_codes(pending, width, carry, carry_bits)
+                write(packed)
+                pending.clear()
+                if code == limit:
+                    packed, carry, carry_bits = pack_codes([CLEAR_CODE], max_bits, carry, carry_bits)
+                    write(packed)
+                    table.clear()
+                    code = FIRST_CODE
+                width = (code - 1).bit_length()
+                check = min((1 << width) + 1, limit)
+        packed, carry, carry_bits = pack_codes(pending, width, carry, carry_bits)
+        write(packed)
+        pending.clear()
+    if prefix >= 0:
+        emit(prefix)
+    packed, carry, carry_bits = pack_codes(pending, width, carry, carry_bits)
+    # Pad to a whole byte; the padding is shorter than any code
+    if carry_bits:
+        packed += bytes([carry << (8 - carry_bits)])
+    write(packed)
+
+
+# Decoder for the variable-width format. Packed bytes come from read(n) in
+# bulk and decoded text is handed to write() in large pieces. Only the
+# strings for codes from FIRST_CODE up are stored.
+def lzw_decode_stream(read, write, max_bits=MAX_CODE_BITS):
+    check_max_bits(max_bits)
+    entries = []
+    add = entries.append
+    count = FIRST_CODE
+    old = None
+    out = []
+    out_size = 0
+    buffer = b""
+    pos = 0
+    acc = 0
+    acc_bits = 0
+    while True:
+        # The decoder adds each entry one code later than the encoder, so its
+        # next free code already has the width the encoder used
+        width = count.bit_length()
+        while acc_bits < width:
+            if pos >= len(buffer):
+                buffer = read(READ_CHUNK)
+                pos = 0
+                if not buffer:
+                    break
+            take = buffer[pos:pos + 4]
+            pos += len(take)
+            acc = (acc << (8 * len(take))) | int.from_bytes(take, byteorder='big')
+            acc_bits += 8 * len(take)
+        if acc_bits < width:
+            break
+        acc_bits -= width
+        num = acc >> acc_bits
+        acc &= (1 << acc_bits) - 1
+        if num < MAX_CHARACTERS:
+            s = chr(num)
+        elif num == CLEAR_CODE:
+            entries.clear()
+            count = FIRST_CODE
+            old = None
+            continue
+        elif num < count:
+            s = entries[num - FIRST_CODE]
+        elif old is not None and num == count:
+            s = old + old[0]
+        else:
+            raise ValueError("Invalid LZW code in compressed data")
+        if old is not None:
+            add(old + s[0])
+            count += 1
+        out.append(s)
+        out_size += len(s)
+        old = s
+        if out_size >= READ_CHUNK:
+            write(''.join(out))
+            out.clear()
+            out_size = 0
+    write(''.join(out))
+
+
+# Characters read so far are reported as progress(characters, total); for
+# text that is not ASCII this runs behind the byte size it is measured against
+def read_chunks(file, size=READ_CHUNK, progress=None, total=0):
+    done = 0
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            break
+        yield chunk
+        done += len(chunk)
+        if progress:
+            progress(done, total)
+
+
+# read(n) for lzw_decode_stream that reports the position in a binary file
+def progress_reader(file, progress, total):
+    def read(size):
+        data = file.read(size)
+        progress(file.tell(), total)
+        return data
+    return read
+
+
+# profile, an instrumentation.Profile, records time and progress. Reading,
+# coding and writing are interleaved, so they make up a single stage.
+# With cache, a result_cache.ResultCache, the file is written in the
+# chunked format instead, split into content-defined chunks whose packed
+# codes are reused from earlier runs; only chunks not seen before are coded.
+def lzw_compress(input_file_path, output_file_path, max_bits=MAX_CODE_BITS, profile=None,
+                 cache=None):
+    profile = as_profile(profile)
+    check_max_bits(max_bits)
+    size = getsize(input_file_path)
+    with open(input_file_path, "r", encoding="utf-8") as file, \
+            open(output_file_path, "wb") as compressed_file:
+        if size == 0:
+            return
+        text = read_chunks(file, progress=profile.progress, total=size)
+        if cache is not None:
+            with profile.stage('encode', size):
+                write_cached_chunks(compressed_file, text, cache, max_bits)
+            return
+        compressed_file.write(LZW_MAGIC + bytes([max_bits]))
+        with profile.stage('encode', size):
+            lzw_encode_chunks(text, compressed_file.write, max_bits)
+
+
+# Write the chunked format from text pieces, looking each content-defined
+# chunk up in cache and compressing the ones that are not there
+def write_cached_chunks(compressed_file, text, cache, max_bits=MAX_CODE_BITS,
+                        chunk_size=CACHE_CHUNK_CHARACTERS):
+    compressed_file.write(LZW_CHUNKED_MAGIC + bytes([max_bits]))
+    offset = compressed_file.tell()
+    entries = []
+    for chunk in content_chunks(text, chunk_size):
+        key = content_key('lzw', {'max_bits': max_bits}, chunk)
+        packed = cache.get(key, len(chunk))
+        if packed is None:
+            packed = compress_chunk(chunk, max_bits)
+            cache.put(key, packed)
+        compressed_file.write(packed)
+        entries.append((offset, len(packed), len(chunk)))
+        offset += len(packed)
+    write_chunk_index(compressed_file, entries, offset)
+
+
+def lzw_decompress(input_file_path, output_file_path, workers=None, profile=None):
+    profile = as_profile(profile)
+    with open(input_file_path, "rb") as file:
+        magic = file.read(len(LZW_MAGIC))
+        if magic == LZW_CHUNKED_MAGIC:
+            lzw_decompress_chunks(input_file_path, output_file_path, workers, profile)
+            return
+        if magic != LZW_MAGIC:
+            with profile.stage('decode', getsize(input_file_path)):
+                lzw_decompress_fixed_width(input_file_path, output_file_path)
+            return
+        max_bits = file.read(1)[0]
+        size = getsize(input_file_path)
+        with profile.stage('decode', size), \
+                open(output_file_path, "w", encoding="utf-8") as decompressed_file:
+            lzw_decode_stream(progress_reader(file, profile.progress, size),
+                              decompressed_file.write, max_bits)
+
+
+def compress_chunk(text, max_bits=MAX_CODE_BITS):
+    out = io.BytesIO()
+    lzw_encode_chunks([text], out.write, max_bits)
+    return out.getvalue()
+
+
+def _compress_counted(text, max_bits):
+    return len(text), compress_chunk(text, max_bits)
+
+
+def decompress_chunk(data, max_bits=MAX_CODE_BITS):
+    out = io.StringIO()
+    lzw_decode_stream(io.BytesIO(data).read, out.write, max_bits)
+    return out.getvalue()
+
+
+# Run fn over items in a pool, yielding results in order while keeping
+# at most `window` tasks in flight so memory stays bounded
+def map_ordered(pool, fn, items, window):
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Write the chunk index that ends the chunked format; offset is where it starts
+def write_chunk_index(file, entries, offset):
+    file.write(len(entries).to_bytes(4, byteorder='big'))
+    for entry in entries:
+        file.write(b''.join(value.to_bytes(8, byteorder='big') for value in entry))
+    file.write(offset.to_bytes(8, byteorder='big'))
+
+
+def read_chunk_index(file):
+    file.seek(0)
+    if file.read(len(LZW_CHUNKED_MAGIC)) != LZW_CHUNKED_MAGIC:
+        raise ValueError("Not a chunked LZW file")
+    max_bits = file.read(1)[0]
+    file.seek(-8, 2)
+    file.seek(int.from_bytes(file.read(8), byteorder='big'))
+    count = int.from_bytes(file.read(4), byteorder='big')
+    index = file.read(24 * count)
+    entries = [tuple(int.from_bytes(index[i + j:i + j + 8], byteorder='big') for j in (0, 8, 16))
+               for i in range(0, len(index), 24)]
+    return max_bits, entries
+
+
+# Compress independent chunks of chunk_size characters across a process
+# pool. Smaller chunks spread better over cores but restart the dictionary
+# more often; the (characters, packed bytes) of every chunk are returned so
+# that cost can be measured.
+def lzw_compress_chunks(input_file_path, output_file_path, chunk_size=CHUNK_CHARACTERS,
+                        max_bits=MAX_CODE_BITS, workers=None, profile=None):
+    profile = as_profile(profile)
+    check_max_bits(max_bits)
+    workers = workers or cpu_count() or 1
+    entries = []
+    done = 0
+    size = getsize(input_file_path)
+    with profile.stage('encode', size), \
+            open(input_file_path, "r", encoding="utf-8") as file, \
+            open(output_file_path, "wb") as compressed_file, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        compressed_file.write(LZW_CHUNKED_MAGIC + bytes([max_bits]))
+        chunks = ((chunk, max_bits) for chunk in read_chunks(file, chunk_size))
+        offset = compressed_file.tell()
+        for characters, packed in map_ordered(pool, _compress_counted, chunks, 2 * workers):
+            compressed_file.write(packed)
+            entries.append((offset, len(packed), characters))
+            offset += len(packed)
+            done += characters
+            profile.progress(done, size)
+        write_chunk_index(compressed_file, entries, offset)
+    return [(characters, size) for _, size, characters in entries]
+
+
+# Decode (data, max_bits) chunks in order. A single chunk, or a single
+# worker, is decoded inline: starting a pool costs more than it saves
+# there, and callers that already run in a pool worker pass workers=1.
+def decompress_chunks(chunks, count, workers):
+    if workers == 1 or count < 2:
+        for data, max_bits in chunks:
+            yield decompress_chunk(data, max_bits)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from map_ordered(pool, decompress_chunk, chunks, 2 * workers)
+
+
+def lzw_decompress_chunks(input_file_path, output_file_path, workers=None, profile=None):
+    profile = as_profile(profile)
+    workers = workers or cpu_count() or 1
+    with profile.stage('decode', getsize(input_file_path)), \
+            open(input_file_path, "rb") as file, \
+            open(output_file_path, "w", encoding="utf-8") as decompressed_file:
+        max_bits, entries = read_chunk_index(file)
+
+        def chunk_data():
+            for offset, size, _ in entries:
+                file.seek(offset)
+                yield file.read(size), max_bits
+
+        texts = decompress_chunks(chunk_data(), len(entries), workers)
+        for done, text in enumerate(texts, 1):
+            decompressed_file.write(text)
+            profile.progress(done, len(entries))
+
+
+# Extra output of chunked compression relative to one whole-file stream,
+# e.g. 0.03 for 3% larger
+def lzw_chunk_ratio_loss(input_file_path, chunk_size=CHUNK_CHARACTERS, max_bits=MAX_CODE_BITS):
+    with open(input_file_path, "r", encoding="utf-8") as file:
+        text = file.read()
+    whole = len(compress_chunk(text, max_bits))
+    chunked = sum(len(compress_chunk(text[start:start + chunk_size], max_bits))
+                  for start in range(0, len(text), chunk_size))
+    return chunked / whole - 1 if whole else 0.0
@@ -0,0 +1,230 @@
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+# On-disk cache of codec results keyed by content hash. A key is the
+# SHA-256 of the codec name, its parameters and the content it codes, so an
+# entry is reused for the same input under the same settings whatever file
+# it came from. Codecs that code independent pieces (Huffman and LZW chunks,
+# DCT image strips) cache each piece, so a file that changed in a few places
+# only has those pieces coded again. Entries are files named by their key
+# under directory/xx/; a lookup refreshes the entry's modification time and
+# the least recently used entries are deleted once the cache outgrows its
+# size bound.
+CACHE_SIZE = 1 << 30
+
+# Bumped when a codec's cached entries change meaning, so old ones are not reused
+CACHE_VERSION = 1
+
+# Eviction deletes entries until the cache is back under this share of its bound
+LOW_WATER = 0.9
+
+# Each process counts the directory again after writing this share of the
+# bound, so processes sharing a cache overshoot it by at most this much each
+RECOUNT = 0.01
+
+# Prefix of entries still being written; they are not counted or evicted
+TEMP_PREFIX = '.tmp-'
+
+# Content-defined chunking: a chunk ends after a symbol where the sum of
+# the gear values of the last CHUNK_WINDOW symbols falls below a threshold.
+# The cut points depend only on nearby content, so an edit moves the
+# boundaries of the chunks around it and leaves the others as they were.
+CHUNK_WINDOW = 32
+GEAR = np.frombuffer(hashlib.shake_128(b'result_cache gear').digest(4 * 256), dtype='<u4')
+
+def content_key(codec, params, content):
+    """Return the cache key of content (bytes, text or an array) coded by
+    codec with params, a dict of JSON values."""
+    digest = hashlib.sha256(
+        f"{CACHE_VERSION}\0{codec}\0{json.dumps(params, sort_keys=True)}\0".encode())
+    if isinstance(content, str):
+        digest.update(b'text\0' + content.encode('utf-8', 'surrogatepass'))
+    elif isinstance(content, np.ndarray):
+        digest.update(f"array\0{content.dtype.str}\0{content.shape}\0".encode())
+        digest.update(np.ascontiguousarray(content).data)
+    else:
+        digest.update(b'bytes\0')
+        digest.update(content)
+    return digest.hexdigest()
+
+def symbol_values(piece):
+    """Return one byte per symbol of text or bytes, for chunking; characters
+    give the low byte of their code point."""
+    if isinstance(piece, str):
+        return np.frombuffer(piece.encode('utf-32-le', 'surrogatepass'), dtype=np.uint8)[::4]
+    return np.frombuffer(piece, dtype=np.uint8)
+
+def content_chunks(pieces, average):
+    """Split text or bytes arriving in pieces into content-defined chunks.
+
+    Chunks average about average symbols and are between a quarter of it
+    and four times it long. The same content gives the same chunks however
+    it is split into pieces.
+    """
+    minimum = max(CHUNK_WINDOW, average // 4)
+    maximum = 4 * average
+    threshold = (1 << 32) // max(1, average - minimum)
+    context = np.zeros(CHUNK_WINDOW, dtype=np.uint32)
+    buffer = None
+    for piece in pieces:
+        if not piece:
+            continue
+        if buffer is None:
+            buffer = piece[:0]
+        offset = len(buffer)
+        buffer += piece
+        gears = np.concatenate((context, GEAR[symbol_values(piece)]))
+        context = gears[-CHUNK_WINDOW:]
+        # Sums wrap modulo 2**32, which the differences undo
+        sums = np.cumsum(gears, dtype=np.uint32)
+        windows = sums[CHUNK_WINDOW:] - sums[:-CHUNK_WINDOW]
+        start = 0
+        for cut in (offset + 1 + np.flatnonzero(windows < threshold)).tolist():
+            while cut - start > maximum:
+                yield buffer[start:start + maximum]
+                start += maximum
+            if cut - start >= minimum:
+                yield buffer[start:cut]
+                start = cut
+        while len(buffer) - start > maximum:
+            yield buffer[start:start + maximum]
+            start += maximum
+        buffer = buffer[start:]
+    if buffer:
+        yield buffer
+
+class ResultCache:
+    """Size-bounded on-disk store of codec results.
+
+    get and put take keys from content_key. hits and misses count the
+    lookups made with get, and hit_bytes and miss_bytes the input bytes
+    those lookups stood for, so hit_bytes is the input that was not coded
+    again. Entries are written atomically, so any number of processes may
+    share a directory. A pickled cache opens as the one instance for its
+    directory in the receiving process (see open_cache).
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Bytes in the directory when it was last counted, and bytes this
+        # process has stored since
+        self.size = None
+        self.added = 0
+        self.hits = self.misses = 0
+        self.hit_bytes = self.miss_bytes = 0
+
+    def __reduce__(self):
+        return open_cache, (self.directory, self.max_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def read(self, key):
+        """Return the entry stored under key, or None, without counting the lookup."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark the entry used; it may have been evicted since it was read
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return data
+
+    def get(self, key, nbytes=0):
+        """Return the entry stored under key, or None; nbytes is the size of
+        the input the entry stands for."""
+        data = self.read(key)
+        self.count(data is not None, nbytes)
+        return data
+
+    def count(self, hit, nbytes=0):
+        """Count a lookup made with read as a hit or a miss of nbytes of input."""
+        if hit:
+            self.hits += 1
+            self.hit_bytes += nbytes
+        else:
+            self.misses += 1
+            self.miss_bytes += nbytes
+
+    def put(self, key, data):
+        """Store data under key, evicting old entries if the cache is full."""
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except FileNotFoundError:
+            # Lost a race with another process clearing the cache; the
+            # entry is just not stored
+            return
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        self.added += len(data)
+        # Other processes store entries too, so the bound is checked
+        # against a fresh count of the directory
+        if (self.size is None or self.size + self.added > self.max_bytes
+                or self.added >= RECOUNT * self.max_bytes):
+            entries = list(self._entries())
+            self.size = sum(size for _, _, size in entries)
+            self.added = 0
+            if self.size > self.max_bytes:
+                self.evict(entries)
+
+    def _entries(self):
+        # (modification time, path, size) of every stored entry; files
+        # other processes are still writing are left out
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith(TEMP_PREFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def evict(self, entries=None):
+        """Delete the least recently used entries until the cache is back
+        under LOW_WATER of its bound. entries, from _entries, saves counting
+        the directory again."""
+        entries = sorted(self._entries() if entries is None else entries)
+        size = sum(size for _, _, size in entries)
+        for _, path, entry_size in entries:
+            if size <= LOW_WATER * self.max_bytes:
+                break
+            # Another process may have evicted it already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= entry_size
+        self.size = size
+        self.added = 0
+
+    def stats(self):
+        """Return the hit and miss counters as a dict."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_bytes': self.hit_bytes, 'miss_bytes': self.miss_bytes}
+
+@functools.lru_cache(maxsize=None)
+def open_cache(directory, max_bytes=CACHE_SIZE):
+    """Return the ResultCache for directory, one per process."""
+    return ResultCache(directory, max_bytes)
+
+def format_cache_stats(stats):
+    """Return ResultCache.stats() (or a sum of them) as one line of text."""
+    return (f"cache: {stats['hits']} hits ({stats['hit_bytes']} bytes reused), "
+            f"{stats['misses']} misses ({stats['miss_bytes']} bytes coded)")